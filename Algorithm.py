@@ -14,10 +14,19 @@
 #    You should have received a copy of the GNU General Public License
 #    along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-import random
-import LidarBotModel as model
 import math
-import time                         # Used for performance measuring
+import statistics
+import numpy as np
+import LidarBotModel as model
+import WorkerPool
+import Instrumentation
+
+# KLD-sampling particle count for k occupied bins, error bound epsilon and
+# z the upper 1-delta quantile of the standard normal, 0 if k <= 1
+def kldParticles(k, epsilon, z):
+    if k <= 1: return 0
+    a = 2.0 / (9.0 * (k - 1))
+    return int(math.ceil((k - 1) / (2.0 * epsilon) * (1.0 - a + math.sqrt(a) * z) ** 3))
 
 #==============================================================================
 #
@@ -27,7 +36,6 @@ import time                         # Used for performance measuring
 class ParticleFilter:
     def __init__(self, parms):
         self.meas               = []
-        self.particles          = []
         self.verbose            = parms['verbose']
         self.width              = parms['arenaWidth']
         self.height             = parms['arenaHeight']
@@ -35,164 +43,476 @@ class ParticleFilter:
         self.numb_of_particles  = parms['numberOfParticles']
         self.lidar_max_dist     = parms['lidarMaxDistance']
         self.init_weight_thres  = parms['initialWeightThres']
+        self.resample_mode      = parms['resampleMode']
+        self.resample_jitter    = parms['resampleJitter']
+        self.particle_count     = 0                                 # Fixed count for lowvariance
+        self.timings            = dict()                            # Seconds per phase of the last update
+        self.data               = (False, 0, 0.0, 0, (0,0,0))       # Last pfData()
+        self.kld_sampling       = parms['kldSampling']
+        self.kld_min            = parms['kldMinParticles']
+        self.kld_max            = parms['kldMaxParticles']
+        self.kld_epsilon        = parms['kldEpsilon']
+        self.kld_bin_size       = parms['kldBinSize']
+        self.kld_z              = statistics.NormalDist().inv_cdf(1 - parms['kldDelta'])
+        self.tracking_mode      = parms['trackingMode']
+        self.tracking_weight    = parms['trackingWeight']
+        self.tracking_spread    = parms['trackingSpread']
+        self.tracking_lost      = parms['trackingLostWeight']
+        self.tracking_window    = parms['trackingWindow']
+        self.tracking           = None                              # (x, y) estimate while tracking
+        self.scan_matching      = parms['scanMatching']
+        self.match_window       = parms['scanMatchWindow']
+        self.match_step         = max(1, parms['scanMatchStep'])
+        self.match_spread       = parms['scanMatchSpread']
+        self.match_margin       = parms['scanMatchMargin']
+        self.match_keep         = parms['scanMatchKeep']
+        self.heading_search     = parms['headingSource'] == 'search'
+        self.keep_threshold     = parms['searchKeepThreshold'] if self.heading_search else 0.9
+        self.redistribute_tries = parms['redistributeTries'] if self.heading_search else None
+        self.global_mode        = parms['globalLocalization']
+        self.pyramid_levels     = parms['pyramidLevels']
+        self.pyramid_hypotheses = parms['pyramidHypotheses']
+        if not isinstance(self.pyramid_hypotheses, (list, tuple)):
+            self.pyramid_hypotheses = [self.pyramid_hypotheses] * self.pyramid_levels
+        self.rng                = np.random.default_rng(parms['randomSeed'])
+        self.particles          = model.ParticleSet(parms, rng=self.rng)
+        self.pool               = None
+        if parms['workers'] > 0:
+            self.pool           = WorkerPool.WorkerPool(parms, self.rng)
 
         if 0:
-            p = model.Particle(parms, myid=1)
             x,y = parms['simulatedRobotPath'][-1]
-            p.place(x, y)
-            self.particles.append(p)
+            self.particles.add([x], [y])
         else:
             self.__resetParticles(parms)
 
-    def __resetParticles(self, parms):
+    # With a window (x, y, size) only the regions within size pixels of x, y
+    # are scanned, nothing is placed if none is above initialWeightThres.
+    # Returns the number of candidates above initialWeightThres.
+    def __resetParticles(self, parms, window=None):
         # For each valid region calculate a weight.
-        print("Scanning valid regions")
-        tester = model.Particle(parms)
-        xy_list = self.__getXYByWeight(tester, self.init_weight_thres)
+        if window is None:
+            print("Scanning valid regions")
+            candidates = self.__getXYByWeight(parms)
+        else:
+            candidates = self.__getXYInWindow(parms, *window)
         print("Placing initial particles - weight > "+str(self.init_weight_thres))
-        i = 0
-        for (x,y) in xy_list:
-            p = model.Particle(parms, myid=i)
-            i += 1
-            p.place(x,y)
-            self.particles.append(p)
-            print("*", end="", flush=True)
-            if self.numb_of_particles and i >= self.numb_of_particles: break
-        print()
+        selected = candidates.weight > self.init_weight_thres
+        if window is not None and not selected.any():
+            return 0
+        if self.resample_mode == 'lowvariance':
+            # Draw a constant number of particles from the candidates
+            if self.kld_sampling:
+                # Global uncertainty, use the upper bound
+                self.particle_count = self.kld_max
+            elif self.particle_count == 0:
+                self.particle_count = self.numb_of_particles or int(selected.sum())
+            candidates.keep(selected)
+            if candidates.resample(self.particle_count, self.resample_jitter):
+                self.particles = candidates
+            print("Placed %d particles"%len(self.particles))
+            return int(selected.sum())
+        if self.numb_of_particles and self.heading_search:
+            # At its best heading most of the arena is above the threshold,
+            # place the best weighted candidates
+            best = np.argsort(-np.where(selected, candidates.weight, -np.inf), kind='stable')
+            selected[best[self.numb_of_particles:]] = False
+        elif self.numb_of_particles:
+            selected &= np.cumsum(selected) <= self.numb_of_particles
+        self.particles.extend(candidates, selected)
+        print("*" * int(selected.sum()))
         print("Placed %d particles"%len(self.particles))
+        return int(selected.sum())
+
+    # Returns a ParticleSet with a weighed particle at every valid region
+    def __getXYByWeight(self, parms):
+        if self.global_mode == 'pyramid':
+            return self.__getXYByPyramid(parms)
+        candidates = model.ParticleSet(parms, rng=self.rng)
+        regions = np.array(self.arena.valid_regions, dtype=np.intp).reshape(-1, 2)
+        candidates.add(regions[:,0], regions[:,1], weigh=self.pool is None)
+        if self.pool is not None:
+            self.pool.weigh(candidates, parms)
+        return candidates
+
+    # Returns a ParticleSet with a weighed particle at every free cell on the
+    # arenaRegion grid within size pixels of x, y
+    def __getXYInWindow(self, parms, x, y, size):
+        region = self.arena.region
+        offsets = np.arange(-(size // region) * region, size + 1, region)
+        dx, dy = np.meshgrid(offsets, offsets)
+        xs = x + dx.reshape(-1)
+        ys = y + dy.reshape(-1)
+        inside = (xs >= 0) & (ys >= 0) & (xs < self.width) & (ys < self.height)
+        xs, ys = xs[inside], ys[inside]
+        free = ~self.arena.checkXYBatch(xs, ys)
+        candidates = model.ParticleSet(parms, rng=self.rng)
+        candidates.add(xs[free], ys[free], weigh=self.pool is None)
+        if self.pool is not None:
+            self.pool.weigh(candidates, parms)
+        return candidates
+
+    #==============================================================================
+    #
+    # Coarse to fine global localization (globalLocalization 'pyramid')
+    #
+    # On the arena downsampled by f = 2^pyramidLevels the valid regions are
+    # grouped in cells of f x arenaRegion pixels, the grid of valid regions
+    # of the coarse level. Each cell with a valid region is one hypothesis,
+    # scored at its valid region nearest the cell center, so the coarse level
+    # scores f^2 fewer hypotheses than there are valid regions. The valid
+    # regions in the best pyramidHypotheses[0] cells are grouped again on the
+    # next finer level, and so on. The valid regions left after the last
+    # coarse level are weighed at full resolution. Coarse levels are scored
+    # with the correlation of the scans (scale invariant), the full
+    # resolution weight uses the configured sensor and weight model.
+    # With headingSource 'search' every hypothesis is scored at its best
+    # heading (headingSearch), the cost does not depend on the headings.
+    # Returns a ParticleSet of the weighed hypotheses, in valid region order.
+    #
+    #==============================================================================
+    def __getXYByPyramid(self, parms):
+        regions = np.array(self.arena.valid_regions, dtype=np.intp).reshape(-1, 2)
+        robot_samples = np.asarray(parms['robotLidarData'], dtype=float)
+        for level, keep in zip(range(self.pyramid_levels, 0, -1), self.pyramid_hypotheses):
+            factor = 2 ** level
+            size = self.arena.region * factor
+            # One hypothesis per cell, the valid region nearest its center
+            cell = regions // size
+            center = (cell + 0.5) * size
+            distance = ((regions - center) ** 2).sum(axis=1)
+            cell_id = cell[:,1] * (self.width // size + 1) + cell[:,0]
+            order = np.lexsort((distance, cell_id))
+            cell_ids, first = np.unique(cell_id[order], return_index=True)
+            if len(cell_ids) <= keep: continue
+            hypotheses = regions[order[first]]
+            arena = self.arena.level(factor)
+            with Instrumentation.span('pyramid%d' % factor):
+                heading = 0.0 if self.heading_search else parms['robotHeading']
+                samples, valid = arena.readLidarBatch(hypotheses[:,0] / factor, hypotheses[:,1] / factor, heading)
+                robot = np.minimum(robot_samples / factor, arena.lidar_max_distance - 1)
+                if self.heading_search:
+                    _, score = model.headingSearch(robot, samples)
+                else:
+                    score = model.correlationWeights(robot, samples)
+                score = np.where(valid & ~np.isnan(score), score, -np.inf)
+                best = np.argpartition(-score, keep)[:keep]
+            Instrumentation.count('pyramidHypotheses', len(hypotheses))
+            regions = regions[np.isin(cell_id, cell_ids[best])]
+        candidates = model.ParticleSet(parms, rng=self.rng)
+        candidates.add(regions[:,0], regions[:,1], weigh=self.pool is None)
+        if self.pool is not None:
+            self.pool.weigh(candidates, parms)
+        return candidates
+
+    #==============================================================================
+    #
+    # Redistribute particles with weights below keepThreshold
+    # next to particles with weights above keepThreshold
+    #
+    # The dump particles are assigned to the keep particles in order,
+    # int(numdump/numkeep) per keep particle. Extra dump particles are left in place.
+    # Each assigned particle is placed at a random location around its keep
+    # particle, within dist. A location is accepted if no other particle was
+    # placed there and the weight at the location is >= 0.5. All particles
+    # still looking for a location try together, up to dist*dist times, and
+    # with headingSource 'search' at most redistributeTries times.
+    # Particles that could not be placed are removed.
+    #
+    # With a center (x, y, spread), from scan matching, only scanMatchKeep of
+    # the dump particles are placed around the keep particles, the others
+    # within spread around the center.
+    #
+    #==============================================================================
+    def __redistribute(self, keep_index, dump_index, dist, center=None):
+        pset = self.particles
+        to_center = dump_index[:0]
+        if center is not None:
+            split = int(len(dump_index) * self.match_keep)
+            dump_index, to_center = dump_index[:split], dump_index[split:]
+        numkeep = len(keep_index)
+        numdump = len(dump_index)
+        per_keep = max(1, int(numdump/numkeep))
+        assigned = np.arange(numdump) // per_keep
+        relocate = dump_index[assigned < numkeep]
+        anchor_x = pset.x[keep_index[assigned[assigned < numkeep]]]
+        anchor_y = pset.y[keep_index[assigned[assigned < numkeep]]]
+        spread = np.full(len(relocate), int(dist))
+        if center is not None:
+            relocate = np.concatenate((relocate, to_center))
+            anchor_x = np.concatenate((anchor_x, np.full(len(to_center), center[0], dtype=np.intp)))
+            anchor_y = np.concatenate((anchor_y, np.full(len(to_center), center[1], dtype=np.intp)))
+            spread = np.concatenate((spread, np.full(len(to_center), int(center[2]))))
+        if self.verbose:
+            for k in range(min(numkeep, len(relocate))):
+                print("(%d,%d,%3f)=%d"%(pset.x[keep_index[k]], pset.y[keep_index[k]], \
+                        pset.weight[keep_index[k]], per_keep), end=" ")
+        if len(anchor_x) == 0: return
+        dist = int(spread.max())
+        # The occupied cells, only in the window the particles can be placed in
+        x0 = max(0, int(anchor_x.min()) - dist)
+        y0 = max(0, int(anchor_y.min()) - dist)
+        x1 = min(self.width, int(anchor_x.max()) + dist + 1)
+        y1 = min(self.height, int(anchor_y.max()) + dist + 1)
+        check_map = np.zeros((max(0, y1 - y0), max(0, x1 - x0)), dtype=bool)
+        kx, ky = pset.x[keep_index], pset.y[keep_index]
+        inside = (kx >= x0) & (kx < x1) & (ky >= y0) & (ky < y1)
+        check_map[ky[inside] - y0, kx[inside] - x0] = True
+        pending = np.arange(len(relocate))
+        tries = dist*dist
+        if self.redistribute_tries is not None:
+            tries = min(tries, self.redistribute_tries)
+        for _ in range(tries):
+            if len(pending) == 0: break
+            d = spread[pending]
+            x = anchor_x[pending] + ((self.rng.random(len(pending))*d) - d/2).astype(np.intp)
+            y = anchor_y[pending] + ((self.rng.random(len(pending))*d) - d/2).astype(np.intp)
+            x = np.clip(x, 0, self.arena.width-1)
+            y = np.clip(y, 0, self.arena.height-1)
+            # One particle per location, first come first served
+            free = ~check_map[y - y0, x - x0]
+            cell = y * self.width + x
+            _, first = np.unique(cell, return_index=True)
+            unique = np.zeros(len(cell), dtype=bool)
+            unique[first] = True
+            trying = np.nonzero(free & unique)[0]
+            weights = pset.place(relocate[pending[trying]], x[trying], y[trying])
+            placed = trying[weights >= 0.5]
+            check_map[y[placed] - y0, x[placed] - x0] = True
+            done = np.zeros(len(pending), dtype=bool)
+            done[placed] = True
+            Instrumentation.count('placementRetries', len(pending) - len(placed))
+            pending = pending[~done]
+        # We could not place these particles
+        Instrumentation.count('droppedParticles', len(pending))
+        failed = np.zeros(len(pset), dtype=bool)
+        failed[relocate[pending]] = True
+        pset.keep(~failed)
+
+    # Lowvariance with a center (x, y, spread), from scan matching: all but
+    # scanMatchKeep of the resampled particles are drawn within spread around
+    # the center, on free pixels, and weighed there. The others keep the
+    # resampled poses so a wrong match can not take over the filter.
+    def __drawAround(self, center):
+        pset = self.particles
+        n = len(pset) - int(len(pset) * self.match_keep)
+        if n <= 0: return
+        index = self.rng.choice(len(pset), n, replace=False)
+        d = int(center[2])
+        x = np.clip(center[0] + ((self.rng.random(n)*d) - d/2).astype(np.intp), 0, self.width-1)
+        y = np.clip(center[1] + ((self.rng.random(n)*d) - d/2).astype(np.intp), 0, self.height-1)
+        free = ~self.arena.checkXYBatch(x, y)
+        pset.place(index[free], x[free], y[free])
+
+    #==============================================================================
+    #
+    # KLD-sampling - adapt the number of particles to the spread of the belief
+    #
+    # The particles with a weight are counted in a kldBinSize spatial histogram.
+    # With k occupied bins, the number of particles needed so the error
+    # between the sample based belief and the true belief is below kldEpsilon
+    # with probability 1-kldDelta is (Fox, 2003):
+    #
+    #   n = (k-1)/(2e) * (1 - 2/(9(k-1)) + sqrt(2/(9(k-1))) * z)^3
+    #
+    # n is clamped to [kldMinParticles, kldMaxParticles].
+    #
+    #==============================================================================
+    def __kldParticleCount(self, dtext):
+        with Instrumentation.span('kld') as span:
+            self.__kldCount()
+        dtext.append(("kld=%d,%d"%(self.kld_bins,self.particle_count), True))
+        dtext.append(("KT:%f"%span.elapsed,False))
+        self.timings['KT'] = span.elapsed
+
+    def __kldCount(self):
+        pset = self.particles
+        support = pset.weight > 0
+        bx = pset.x[support] // self.kld_bin_size
+        by = pset.y[support] // self.kld_bin_size
+        k = len(np.unique(by * (self.width // self.kld_bin_size + 1) + bx))
+        n = kldParticles(k, self.kld_epsilon, self.kld_z)
+        self.particle_count = min(max(n, self.kld_min), self.kld_max)
+        self.kld_bins = k
+
+    def __predict(self, keep_index):
+        with Instrumentation.span('predict'):
+            return self.__predictXY(keep_index)
 
-    # Returns list (x,y) tuples based on weight
-    def __getXYByWeight(self, particle, threshold):
-        return [(particle.x,particle.y) \
-            for position in self.arena.valid_regions \
-                if particle.place(position[0], position[1]) > threshold]
-
-    # Computes distance between point1 and point2. Points are (x, y) pairs.
-    def __DistanceBetween(self, point1, point2):
-        (x1, y1) = point1
-        (x2, y2) = point2
-        return math.sqrt((x2 - x1) ** 2 + (y2 - y1) ** 2)
-
-    # Place the relocate particle in a random location around the keep particle
-    # within distance.
-    def __placeNextTo(self, keep_particle, relocate_particle, check_map, dist):
-        # Place the relocate particle within distance from x,y
-        # Width, Height, x, y 
-        dist = int(dist)
-        for x in range(dist):
-            for y in range(dist):
-                if self.arena.CheckXY(x,y):
-                    check_map[y][x] = True
-
-        for tries in range(dist*dist):
-            x = keep_particle.x + int((random.random()*dist) - dist/2)
-            y = keep_particle.y + int((random.random()*dist) - dist/2)
-            x = max(0,x)
-            y = max(0,y)
-            x = min(x,self.arena.width-1)
-            y = min(y,self.arena.height-1)
-            if check_map[y][x] == False:
-                if relocate_particle.place(x,y) >= 0.5:
-                    check_map[y][x] = True
-                    return True
-        return False # We could not place the particle
-
-    def __predict(self,kp):
-        pc = len(kp)
+    def __predictXY(self, keep_index):
+        pc = len(keep_index)
         if pc == 0: return (0,0,0)
-        if pc == 1: return (kp[0].x, kp[0].y, 3)
-        distance = 0
-        for i in range(pc-1):
-            distance += self.__DistanceBetween((kp[i].x,kp[i].y),(kp[i+1].x,kp[i+1].y))
-        xa = 0
-        ya = 0
-        for p in kp:
-            xa += p.x
-            ya += p.y
-        return (int(xa/pc),int(ya/pc),int(distance/pc))
+        x = self.particles.x[keep_index]
+        y = self.particles.y[keep_index]
+        if pc == 1: return (int(x[0]), int(y[0]), 3)
+        # Distance between consecutive keep particles
+        distance = np.sqrt(np.diff(x) ** 2 + np.diff(y) ** 2).sum()
+        return (int(x.sum()/pc),int(y.sum()/pc),int(distance/pc))
+
+    #==============================================================================
+    #
+    # Correlative scan matching (scanMatching, -S)
+    #
+    # The prediction is refined by weighing the free cells on a scanMatchStep
+    # grid within scanMatchWindow of it, then every cell within scanMatchStep/2
+    # of the best one. Poses are weighed like particles (sensor, weight and
+    # heading model). The best pose is the match if its weight is above
+    # threshold and at least scanMatchMargin above the weight at the
+    # prediction.
+    # Returns the match (x, y, scanMatchSpread) or None.
+    #
+    #==============================================================================
+    def __scanMatch(self, prediction, parms, threshold):
+        with Instrumentation.span('scanMatch'):
+            x, y, _ = prediction
+            best = self.__bestPose(x, y, self.match_window, self.match_step, parms)
+            if best is None: return None
+            fine = self.__bestPose(best[0], best[1], self.match_step // 2, 1, parms)
+            if fine is not None and fine[2] >= best[2]: best = fine
+            at_prediction = self.__bestPose(x, y, 0, 1, parms)
+            if best[2] <= threshold or (at_prediction is not None and best[2] < at_prediction[2] + self.match_margin):
+                return None
+            return (best[0], best[1], self.match_spread)
+
+    # Returns (x, y, weight) of the best free cell on a step grid within
+    # window of x, y, None if no cell is free.
+    def __bestPose(self, x, y, window, step, parms):
+        offsets = np.arange(-(window // step) * step, window + 1, step)
+        dx, dy = np.meshgrid(offsets, offsets)
+        xs = x + dx.reshape(-1)
+        ys = y + dy.reshape(-1)
+        inside = (xs >= 0) & (ys >= 0) & (xs < self.width) & (ys < self.height)
+        xs, ys = xs[inside], ys[inside]
+        free = ~self.arena.checkXYBatch(xs, ys)
+        if not free.any(): return None
+        Instrumentation.count('scanMatchPoses', int(free.sum()))
+        poses = model.ParticleSet(parms, rng=self.rng)
+        poses.add(xs[free], ys[free])
+        # Poses next to a wall often see the same scan, the match is the
+        # best pose nearest to the middle of the best poses
+        best = np.nonzero(poses.weight >= poses.weight.max() - 1e-6)[0]
+        cx, cy = poses.x[best].mean(), poses.y[best].mean()
+        i = best[np.argmin((poses.x[best] - cx) ** 2 + (poses.y[best] - cy) ** 2)]
+        return (int(poses.x[i]), int(poses.y[i]), float(poses.weight[i]))
+
+    #==============================================================================
+    #
+    # Tracking mode (trackingMode, -t)
+    #
+    # Once the average weight is above trackingWeight and the prediction
+    # radius is below trackingSpread the filter is tracking. A reset while
+    # tracking scans only the regions within trackingWindow of the last
+    # estimate, placement is always local (the check map only covers the
+    # window the particles are placed in) and ray casts are per particle,
+    # so an update does not depend on the size of the arena. The filter falls
+    # back to global mode when the average weight drops below
+    # trackingLostWeight or the local reset finds nothing.
+    #
+    #==============================================================================
+    def __reset(self, parms, dtext):
+        if self.tracking is not None:
+            window = self.tracking + (self.tracking_window,)
+            if self.__resetParticles(parms, window):
+                dtext.append(("local reset", False))
+                return
+            self.__lostTrack(dtext)
+        self.__resetParticles(parms)
+
+    def __track(self, prediction, dtext):
+        if not self.tracking_mode: return
+        average = self.__avgWeight()
+        if self.tracking is None:
+            if average >= self.tracking_weight and prediction[2] <= self.tracking_spread:
+                self.tracking = prediction[:2]
+                dtext.append(("tracking", True))
+        elif average < self.tracking_lost:
+            self.__lostTrack(dtext)
+        else:
+            self.tracking = prediction[:2]
+
+    def __lostTrack(self, dtext):
+        self.tracking = None
+        dtext.append(("global", True))
+
+    # Stop the worker processes
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool = None
 
     def pfData(self, keep=0, done=False, prediction=(0,0,0)):
         nump = len(self.particles)
         avgw = self.__avgWeight()
-        return (done, nump, avgw, keep, prediction)
+        self.data = (done, nump, avgw, keep, prediction)
+        return self.data
 
     # move particles
     # return True to end simulation
     def update(self, parms, dtext):
         # move particles
-        start_time = time.perf_counter()
-        for p in self.particles:
-            p.move()
-        elapsed_time = time.perf_counter() - start_time
-        dtext.append(("MT:%f"%elapsed_time,False))
+        self.timings = dict()
+        with Instrumentation.span('move') as span:
+            if self.pool is not None:
+                self.pool.move(self.particles, parms)
+            else:
+                self.particles.move()
+        dtext.append(("MT:%f"%span.elapsed,False))
+        self.timings['MT'] = span.elapsed
 
         # If the robot is in a deadzone, we do not have enough data to 
         # make a decision on how to place particles
         if not parms['robotValidLidar']: return self.pfData()
 
         # refresh dead particles
-        keepThreashold = 0.9
-        # keep_particles is a list of particles with weights > keepThreashold
-        keep_particles = [p for p in self.particles if p.weight > keepThreashold]
-        numkeep = len(keep_particles)
+        keepThreashold = self.keep_threshold
+        # keep_index are the particles with weights > keepThreashold
+        keep_index = np.nonzero(self.particles.weight > keepThreashold)[0]
+        numkeep = len(keep_index)
         if self.verbose: print("keep=%d"%(numkeep), end=" ")
         # The object is to keep particles with weights above keepThreshold
-        dump_particles = [p for p in self.particles if p.weight <= keepThreashold]
-        numdump = len(dump_particles)
+        dump_index = np.nonzero(self.particles.weight <= keepThreashold)[0]
+        numdump = len(dump_index)
         if self.verbose: print("dump=%d"%(numdump), end=" ")
-        if numkeep == 0:
-            # if we do not have any good hypothesus (particles) we need to guess
-            self.__resetParticles(parms)
-        else:
-            start_time = time.perf_counter()
-            # Place low weight particles next to high weight particles
-            keep = 0
-            dump = 0
-            r = 0
-            check_map = [[False for c in range(self.width)] for r in range(self.height)]
-            for p in keep_particles:
-                check_map[p.y][p.x] = True
-            # Redistribute particles with weights below keepThreshold
-            # next to particles with weights above keepThreshold
-            for relocate_particle in dump_particles:
-                if keep < numkeep:
-                    # for each keep particle assign X dump particles
-                    if self.__placeNextTo(keep_particles[keep], relocate_particle, check_map, \
-                            self.lidar_max_dist/2) == False:
-                        self.particles.remove(relocate_particle)
-                    if self.verbose and dump == 0:
-                        x = keep_particles[keep].x
-                        y = keep_particles[keep].y
-                        w = keep_particles[keep].weight
-                        print("(%d,%d,%3f)"%(x,y,w), end="")
-                    dump += 1
-                    # We assigne 10% of the dump particles to each keep particle
-                    if dump >= int(numdump/numkeep):
-                        keep += 1
-                        if self.verbose: print("=%d"%(dump), end=" ")
-                        dump = 0
-                else:
-                    # We have assigne 10 dump particles to each keep particle but we have
-                    # extra dump particles
-                    k = 0
+        with Instrumentation.span('refresh') as span:
+            if numkeep == 0:
+                # if we do not have any good hypothesus (particles) we need to guess
+                with Instrumentation.span('reset'):
+                    self.__reset(parms, dtext)
+                prediction = self.__predict(keep_index)
+            elif self.resample_mode == 'lowvariance':
+                prediction = self.__predict(keep_index)
+                match = self.__scanMatch(prediction, parms, keepThreashold) if self.scan_matching else None
+                if match: prediction = match
+                if self.kld_sampling:
+                    self.__kldParticleCount(dtext)
+                with Instrumentation.span('resample'):
+                    self.particles.resample(self.particle_count, self.resample_jitter)
+                    if match:
+                        # Tighten the particles around the matched pose
+                        self.__drawAround(match)
+            else:
+                # Place low weight particles next to high weight particles
+                prediction = self.__predict(keep_index)
+                match = self.__scanMatch(prediction, parms, keepThreashold) if self.scan_matching else None
+                with Instrumentation.span('redistribute'):
+                    if match:
+                        # Tighten the particles around the matched pose
+                        prediction = match
+                        self.__redistribute(keep_index, dump_index, self.lidar_max_dist/2, center=match)
+                    else:
+                        self.__redistribute(keep_index, dump_index, self.lidar_max_dist/2)
 
-        elapsed_time = time.perf_counter() - start_time
-        dtext.append(("PT:%f"%elapsed_time,False))
-        return self.pfData(keep=len(keep_particles), prediction=self.__predict(keep_particles))
+        dtext.append(("PT:%f"%span.elapsed,False))
+        self.timings['PT'] = span.elapsed
+        if numkeep: self.__track(prediction, dtext)
+        return self.pfData(keep=numkeep, prediction=prediction)
 
     def __avgWeight(self):
-        avg = 0.0
-        for p in self.particles:
-            avg += p.weight
-        return avg / len(self.particles)
+        if len(self.particles) == 0: return 0.0
+        return float(self.particles.weight.mean())
 
     def __avgXY(self):
-        x = 0.0
-        y = 0.0
         n = len(self.particles)
-        for p in self.particles:
-            x += (p.weight * p.x)
-            y += (p.weight * p.y)
+        x = (self.particles.weight * self.particles.x).sum()
+        y = (self.particles.weight * self.particles.y).sum()
         return int(x/n), int(y/n)
-
-
@@ -16,6 +16,12 @@
 
 import cv2
 import math
+import os
+import hashlib
+import collections
+import numpy as np
+from multiprocessing import shared_memory
+import Instrumentation
 
 #==============================================================================
 #
@@ -26,87 +32,535 @@ class Arena:
 
     def __init__(self, parameters):
         print("Loading arena: ", parameters['arenaFilename'])
-        self.__image                = cv2.imread(parameters['arenaFilename'])
-        try:
-            height, width, channels     = self.__image.shape
-        except:
-            raise Exception("Arena file not found")
+        self.__filename             = parameters['arenaFilename']
+        self.__image                = None
+        self.__loadOccupancy(parameters)
+        self.__createClearance(parameters)
+        height, width               = self.__occupied.shape
         self.lidar_max_distance     = parameters['lidarMaxDistance']
         self.lidar_samples          = parameters['lidarSamples']
         self.parms                  = parameters
+        self.__shared               = None
+        self.__share_count          = 0 # share() calls not yet matched by unshare()
+        self.__levels               = dict()
+        self.__memo                 = collections.OrderedDict()
+        self.memo_size              = parameters['scanCacheSize']
         self.width                  = width
         self.height                 = height
         parameters['arenaHeight']   = height
         parameters['arenaWidth']    = width
         self.region                 = parameters['arenaRegion']
-        print("height = %d, width = %d, channels = %d" % (height, width, channels))
+        print("height = %d, width = %d" % (height, width))
         self.__createValidRegions(parameters)
         self.__createLidarScan(parameters)
+        if parameters['sensorModel'] == 'likelihood':
+            self.__createDistanceField()
+        self.scan_table             = None
+        if parameters['scanTable']:
+            self.__loadScanTable(parameters)
+
+    # The color arena image, only loaded when it is used (graphics)
+    def GetImage(self):
+        if self.__image is None:
+            if self.__filename.endswith('.npy'):
+                # White walls on black
+                gray            = np.where(self.__occupied, 255, 0).astype(np.uint8)
+                self.__image    = cv2.cvtColor(gray, cv2.COLOR_GRAY2BGR)
+            else:
+                self.__image    = self.__readImage(self.__filename)
+        return self.__image
+
+    def __readImage(self, filename):
+        image = cv2.imread(filename)
+        if image is None:
+            raise Exception("Arena file not found")
+        return image
+
+    #==============================================================================
+    #
+    # Shared memory - used by WorkerPool
+    #
+    # share() copies the arrays used for ray casting and weighing into shared
+    # memory and returns a picklable description. attach() builds an Arena in
+    # a worker process from the description, without loading the image.
+    # Arrays that are memory mapped files (occupancy grid, clearance, scan
+    # table) are not copied, workers map the same files.
+    # unshare() releases the shared memory once every share() is matched.
+    #
+    #==============================================================================
+    def share(self):
+        self.__share_count += 1
+        if self.__shared is None:
+            self.__shared = []
+            description = {'width'              : self.width,
+                           'height'             : self.height,
+                           'lidarSamples'       : self.lidar_samples,
+                           'lidarMaxDistance'   : self.lidar_max_distance,
+                           'scanTable'          : None,
+                           'scanCacheSize'      : self.memo_size,
+                           'files'              : {},
+                           'arrays'             : {}}
+            if self.scan_table is not None:
+                description['scanTable'] = (self.scan_table.filename, self.scan_table_stride)
+            arrays = {'occupied': self.__occupied, 'clearance': self.clearance,
+                      'scan_dx': self.scan_dx, 'scan_dy': self.scan_dy}
+            if hasattr(self, 'distance_field'):
+                arrays['distance_field'] = self.distance_field
+            for name, array in arrays.items():
+                if isinstance(array, np.memmap):
+                    description['files'][name] = array.filename
+                    continue
+                shm = shared_memory.SharedMemory(create=True, size=max(1, array.nbytes))
+                np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+                self.__shared.append(shm)
+                description['arrays'][name] = (shm.name, array.shape, array.dtype.str)
+            self.__shared_description = description
+        return self.__shared_description
 
-    def GetImage(self): return self.__image
+    def unshare(self):
+        self.__share_count -= 1
+        if self.__shared is not None and self.__share_count <= 0:
+            for shm in self.__shared:
+                shm.close()
+                shm.unlink()
+            self.__shared = None
+
+    @staticmethod
+    def attach(description, parameters):
+        arena                       = Arena.__new__(Arena)
+        arena.parms                 = parameters
+        arena.width                 = description['width']
+        arena.height                = description['height']
+        arena.lidar_samples         = description['lidarSamples']
+        arena.lidar_max_distance    = description['lidarMaxDistance']
+        arena.__shared              = [] # Keeps the segments mapped, not unlinked by the worker
+        arena.__levels              = dict()
+        arena.__memo                = collections.OrderedDict()
+        arena.memo_size             = description['scanCacheSize']
+        arrays                      = dict()
+        for name, (shm_name, shape, dtype) in description['arrays'].items():
+            shm = shared_memory.SharedMemory(name=shm_name)
+            arena.__shared.append(shm)
+            arrays[name] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+        for name, filename in description['files'].items():
+            arrays[name] = np.load(filename, mmap_mode='r')
+        arena.__occupied            = arrays.pop('occupied').view(bool)
+        for name, array in arrays.items():
+            setattr(arena, name, array)
+        arena.scan_table            = None
+        if description['scanTable'] is not None:
+            filename, arena.scan_table_stride = description['scanTable']
+            arena.scan_table        = np.load(filename, mmap_mode='r')
+        return arena
 
     # If True than collision
     def CheckXY(self, x, y):
         if x >= self.width: return  True
         if y >= self.height: return True
-        pos = self.__image[int(y),int(x)]
-        if pos[0] == 255 and pos[1] == 255 and pos[2] == 255:
-            return True
-        return False
-
-    def readLidar(self, x, y, samples, max_dist=1000):
-            # Measure distance while incrementing heading.
-            # Start scan at robot heading.
-            if max_dist > self.lidar_max_distance:
-                max_dist = self.lidar_max_distance
-            sample_count = self.lidar_samples
-            s = int(self.parms['robotHeading']/((2 * math.pi)/self.lidar_samples))
-            valid = False
-            zcount = 0
-            for r in range(sample_count):
-                i = (r+s) % self.lidar_samples
-                for d in range(1,max_dist):
-                    (xa,ya) = self.scan_points[i][d]
-                    if self.CheckXY(x+xa,y+ya):
-                        valid = True
-                        break
-                samples[r] = d
-                if d == 0: zcount += 1
-            if zcount == sample_count:
-                for r in range(sample_count):
-                    i = (r+s) % self.lidar_samples
-                    d = self.lidar_max_distance-1
-                    (xa,ya) = self.scan_points[i][d]
-                    if not self.CheckXY(x+xa,y+ya):
-                        samples[r] = d
-                        valid = True
-                    else:
-                        samples[r] = 0
-            return valid
+        return bool(self.__occupied[int(y),int(x)])
+
+    #==============================================================================
+    #
+    # Pyramid - coarser copies of the arena for global localization
+    #
+    # level(f) is the arena downsampled by f. A cell is a wall if any of its
+    # f x f pixels is a wall, cells past the right/bottom edge are walls, and
+    # the lidar range is lidarMaxDistance/f, so a ray cast costs 1/f of a full
+    # resolution one. Positions and distances on a level are in its cells.
+    # Each level is built once.
+    #
+    #==============================================================================
+    def level(self, factor):
+        if factor == 1: return self
+        if factor not in self.__levels:
+            height                  = -(-self.height // factor)
+            width                   = -(-self.width // factor)
+            occupied                = np.ones((height * factor, width * factor), dtype=bool)
+            occupied[:self.height, :self.width] = self.__occupied
+            arena                   = Arena.__new__(Arena)
+            arena.parms             = self.parms
+            arena.width             = width
+            arena.height            = height
+            arena.lidar_samples     = self.lidar_samples
+            arena.lidar_max_distance= max(2, -(-self.lidar_max_distance // factor))
+            arena.__occupied        = occupied.reshape(height, factor, width, factor).any(axis=(1, 3))
+            arena.__levels          = dict()
+            arena.__memo            = collections.OrderedDict()
+            arena.memo_size         = 0
+            arena.scan_table        = None
+            arena.__createLidarScan(self.parms)
+            self.__levels[factor]   = arena
+        return self.__levels[factor]
+
+    # Scan the lidar from a single position and heading, samples is filled
+    # in place. Returns True if any beam hit a wall.
+    def readLidar(self, x, y, samples, max_dist=1000, *, heading):
+            scan, valid = self.readLidarBatch([x], [y], heading, max_dist)
+            samples[:] = scan[0].tolist()
+            return bool(valid[0])
+
+    #==============================================================================
+    #
+    # readLidarBatch - Scan the lidar from N positions in one vectorized call
+    #
+    #   xs, ys  - arrays of positions
+    #   heading - robot heading in radians, scalar or one per position.
+    #             Required, parms is shared by the sessions of all the robots.
+    #
+    # Returns (samples, valid):
+    #   samples - N x lidarSamples matrix of distances, the scan starts at heading
+    #   valid   - N vector, True if any beam hit a wall
+    #
+    # A beam that does not hit a wall reads max_dist-1, same as readLidar.
+    #==============================================================================
+    def readLidarBatch(self, xs, ys, heading, max_dist=1000):
+        if max_dist > self.lidar_max_distance:
+            max_dist = self.lidar_max_distance
+        max_dist    = max(max_dist, 2)
+        xs          = np.asarray(xs, dtype=float).reshape(-1)
+        ys          = np.asarray(ys, dtype=float).reshape(-1)
+        n           = len(xs)
+        heading     = np.broadcast_to(np.asarray(heading, dtype=float), (n,))
+        # Start scan at robot heading, int() truncates toward zero
+        s           = np.trunc(heading/((2 * math.pi)/self.lidar_samples)).astype(np.intp)
+        beams       = (np.arange(self.lidar_samples) + s[:,None]) % self.lidar_samples
+        if self.scan_table is not None and max_dist == self.lidar_max_distance:
+            Instrumentation.count('scanTableLookups', len(xs))
+            with Instrumentation.span('scanTable'):
+                return self.__gatherScanTable(xs, ys, beams)
+        with Instrumentation.span('rayCast'):
+            samples, hits = self.__castBatch(xs, ys, beams, max_dist)
+        return samples, hits.any(axis=1)
+
+    #==============================================================================
+    #
+    # Scan memo - readLidarBatch for pixel positions (particles)
+    #
+    # Particles on the same pixel with the same scan start beam see the same
+    # scan. readLidarMemo() scans each distinct (x, y, start beam) once and
+    # keeps the last scanCacheSize scans in an LRU memo, so a pose scanned on
+    # an earlier update is not cast again. With the scan table every scan is
+    # already a lookup, only the duplicates are skipped.
+    # Instrumentation counters, per pose: scanDedupHits (same pose as another
+    # particle), scanCacheHits and scanCacheMisses (memo).
+    #
+    #==============================================================================
+    def readLidarMemo(self, xs, ys, heading):
+        xs          = np.asarray(xs, dtype=np.intp).reshape(-1)
+        ys          = np.asarray(ys, dtype=np.intp).reshape(-1)
+        n           = len(xs)
+        heading     = np.broadcast_to(np.asarray(heading, dtype=float), (n,))
+        s           = np.trunc(heading/((2 * math.pi)/self.lidar_samples)).astype(np.intp) % self.lidar_samples
+        poses, first, inverse = np.unique(np.stack((xs, ys, s), axis=1), axis=0,
+                                    return_index=True, return_inverse=True)
+        inverse     = inverse.reshape(-1)
+        Instrumentation.count('scanDedupHits', n - len(poses))
+        if self.memo_size <= 0 or self.scan_table is not None:
+            samples, valid = self.readLidarBatch(xs[first], ys[first], heading[first])
+            return samples[inverse], valid[inverse]
+        samples     = np.empty((len(poses), self.lidar_samples), dtype=np.intp)
+        valid       = np.empty(len(poses), dtype=bool)
+        keys        = [tuple(pose) for pose in poses.tolist()]
+        miss        = []
+        for i, key in enumerate(keys):
+            scan = self.__memo.get(key)
+            if scan is None:
+                miss.append(i)
+                continue
+            self.__memo.move_to_end(key)
+            samples[i], valid[i] = scan
+        Instrumentation.count('scanCacheHits', len(poses) - len(miss))
+        Instrumentation.count('scanCacheMisses', len(miss))
+        if miss:
+            miss            = np.array(miss)
+            cast, hit       = self.readLidarBatch(xs[first[miss]], ys[first[miss]], heading[first[miss]])
+            samples[miss]   = cast
+            valid[miss]     = hit
+            for i in miss[-self.memo_size:]:
+                self.__memo[keys[i]] = (samples[i].copy(), bool(valid[i]))
+            while len(self.__memo) > self.memo_size:
+                self.__memo.popitem(last=False)
+        return samples[inverse], valid[inverse]
+
+    # Ray cast the beams from each position, one row of beams per position.
+    # Returns (samples, hits), hits is True for each beam that hit a wall.
+    def __castBatch(self, xs, ys, beams, max_dist):
+        n           = len(xs)
+        samples     = np.empty((n, self.lidar_samples), dtype=np.intp)
+        hits        = np.empty((n, self.lidar_samples), dtype=bool)
+        # Limit the size of the n x samples x distance hit cube
+        block       = max(1, 4000000 // (self.lidar_samples * max_dist))
+        Instrumentation.count('rayCasts', beams.size)
+        Instrumentation.count('beamSteps', beams.size * (max_dist - 1))
+        for b in range(0, n, block):
+            e = min(n, b + block)
+            dx = self.scan_dx[beams[b:e], 1:max_dist]
+            dy = self.scan_dy[beams[b:e], 1:max_dist]
+            hit = self.checkXYBatch(xs[b:e,None,None] + dx, ys[b:e,None,None] + dy)
+            hits[b:e] = hit.any(axis=2)
+            samples[b:e] = np.where(hits[b:e], hit.argmax(axis=2) + 1, max_dist - 1)
+        return samples, hits
+
+    #==============================================================================
+    #
+    # Scan lookup table
+    #
+    # The arena is static, so the scan from a cell never changes. The distance
+    # for every beam from every scanTableStride cell is computed once with
+    # heading 0 and stored in a uint16 file in cacheDirectory, keyed by the
+    # map hash, lidarSamples, lidarMaxDistance and the stride. At startup the
+    # file is memory mapped. A heading is a circular shift of the beam index,
+    # so a scan becomes a gather from the table.
+    #
+    # A beam that did not hit a wall is stored as 0.
+    #==============================================================================
+    def __loadScanTable(self, parms):
+        self.scan_table_stride  = max(1, int(parms['scanTableStride']))
+        st                      = self.scan_table_stride
+        filename = os.path.join(parms['cacheDirectory'], "scans_%s_%d_%d_%d.npy" % \
+                (self.map_hash[:16], self.lidar_samples, self.lidar_max_distance, st))
+        if not os.path.exists(filename):
+            self.__buildScanTable(filename, st)
+        print("Loading scan table: "+filename)
+        self.scan_table         = np.load(filename, mmap_mode='r')
+
+    def __buildScanTable(self, filename, st):
+        print("Building scan table")
+        os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+        rows        = (self.height + st - 1) // st
+        cols        = (self.width + st - 1) // st
+        temp        = filename + ".tmp"
+        table       = np.lib.format.open_memmap(temp, mode='w+', dtype=np.uint16,
+                            shape=(rows, cols, self.lidar_samples))
+        xs          = np.arange(cols) * st
+        beams       = np.broadcast_to(np.arange(self.lidar_samples), (cols, self.lidar_samples))
+        for r in range(rows):
+            samples, hits = self.__castBatch(xs, np.full(cols, r * st), beams,
+                                self.lidar_max_distance)
+            table[r] = np.where(hits, samples, 0)
+            if r % 50 == 0: print("*", end="", flush=True)
+        print()
+        table.flush()
+        del table
+        os.replace(temp, filename)
+
+    def __gatherScanTable(self, xs, ys, beams):
+        st          = self.scan_table_stride
+        rows, cols  = self.scan_table.shape[:2]
+        if st == 1:
+            cx      = np.floor(xs).astype(np.intp)
+            cy      = np.floor(ys).astype(np.intp)
+        else:
+            # Nearest table cell
+            cx      = np.floor(xs/st + 0.5).astype(np.intp)
+            cy      = np.floor(ys/st + 0.5).astype(np.intp)
+        inside      = (xs >= 0) & (ys >= 0) & (cx < cols) & (cy < rows)
+        if not inside.all():
+            # Positions outside the table are ray cast
+            samples     = np.empty(beams.shape, dtype=np.intp)
+            valid       = np.empty(len(xs), dtype=bool)
+            outside     = ~inside
+            s, hits     = self.__castBatch(xs[outside], ys[outside], beams[outside],
+                                self.lidar_max_distance)
+            samples[outside] = s
+            valid[outside] = hits.any(axis=1)
+            if inside.any():
+                s, v = self.__gatherScanTable(xs[inside], ys[inside], beams[inside])
+                samples[inside] = s
+                valid[inside] = v
+            return samples, valid
+        table       = self.scan_table[cy[:,None], cx[:,None], beams]
+        valid       = (table != 0).any(axis=1)
+        samples     = np.where(table == 0, self.lidar_max_distance - 1, table).astype(np.intp)
+        return samples, valid
+
+    # Vectorized CheckXY, True where collision
+    def checkXYBatch(self, x, y):
+        x       = np.trunc(x).astype(np.intp)
+        y       = np.trunc(y).astype(np.intp)
+        # Match CheckXY, past the right/bottom edge is a collision and
+        # negative indices wrap around the image.
+        outside = (x >= self.width) | (y >= self.height) | \
+                  (x < -self.width) | (y < -self.height)
+        x       = np.where(outside, 0, x)
+        y       = np.where(outside, 0, y)
+        return outside | self.__occupied[y, x]
+
+    #==============================================================================
+    #
+    # Occupancy grid - one byte per pixel, True where the arena pixel is white (wall)
+    #
+    # arenaFilename is an image, or a .npy occupancy grid (bool, or uint8 0/1)
+    # for maps that are too large to decode on every run. An image is
+    # converted once, a block of rows at a time, into
+    # cacheDirectory/occupancy_<map hash>.npy (occupancyCache). The grid is
+    # memory mapped from the cache or the .npy, so only the pages that are
+    # used are read. The map hash is the hash of the image file, or of the
+    # .npy file name, size and time, and keys all the arena caches.
+    #
+    #==============================================================================
+    def __loadOccupancy(self, parms):
+        filename = self.__filename
+        try:
+            if filename.endswith('.npy'):
+                stat = os.stat(filename)
+                key = "%s %d %d" % (os.path.abspath(filename), stat.st_size, stat.st_mtime_ns)
+                self.map_hash   = hashlib.sha1(key.encode()).hexdigest()
+                occupied        = np.load(filename, mmap_mode='r')
+                self.__occupied = occupied.view(bool) if occupied.dtype == np.uint8 else occupied
+                return
+            with open(filename, "rb") as fp:
+                self.map_hash   = hashlib.sha1(fp.read()).hexdigest()
+        except OSError:
+            raise Exception("Arena file not found")
+        cache = os.path.join(parms['cacheDirectory'], "occupancy_%s.npy" % self.map_hash[:16])
+        if parms['occupancyCache'] and os.path.exists(cache):
+            self.__occupied = np.load(cache, mmap_mode='r')
+            return
+        image = self.__readImage(filename)
+        if not parms['occupancyCache']:
+            self.__occupied = np.all(image == 255, axis=2)
+            return
+        print("Building occupancy grid")
+        os.makedirs(parms['cacheDirectory'], exist_ok=True)
+        temp        = cache + ".tmp"
+        occupied    = np.lib.format.open_memmap(temp, mode='w+', dtype=bool, shape=image.shape[:2])
+        for row in range(0, image.shape[0], 1024):
+            occupied[row:row+1024] = np.all(image[row:row+1024] == 255, axis=2)
+        occupied.flush()
+        del occupied
+        os.replace(temp, cache)
+        self.__occupied = np.load(cache, mmap_mode='r')
+
+    #==============================================================================
+    #
+    # Clearance - distance from every pixel to the closest wall or arena edge,
+    # in pixels, capped at 255 (one byte per pixel)
+    #
+    # A particle with more clearance than it can travel in one move can not
+    # collide, so move() skips its collision probes. Computed in bands of rows
+    # with a 255 row margin, so large arenas do not need a full size float
+    # image, and cached next to the occupancy grid.
+    #
+    #==============================================================================
+    def __createClearance(self, parms):
+        cache = os.path.join(parms['cacheDirectory'], "clearance_%s.npy" % self.map_hash[:16])
+        if parms['occupancyCache'] and os.path.exists(cache):
+            self.clearance = np.load(cache, mmap_mode='r')
+            return
+        height, width   = self.__occupied.shape
+        if parms['occupancyCache']:
+            os.makedirs(parms['cacheDirectory'], exist_ok=True)
+            clearance   = np.lib.format.open_memmap(cache + ".tmp", mode='w+', dtype=np.uint8, shape=(height, width))
+        else:
+            clearance   = np.empty((height, width), dtype=np.uint8)
+        band, margin    = 1024, 255
+        for row in range(0, height, band):
+            r0          = max(0, row - margin)
+            r1          = min(height, row + band + margin)
+            free        = np.where(self.__occupied[r0:r1], 0, 255).astype(np.uint8)
+            # The arena edges are walls
+            top         = 1 if r0 == 0 else 0
+            free        = cv2.copyMakeBorder(free, top, 1 if r1 == height else 0, 1, 1, cv2.BORDER_CONSTANT, value=0)
+            distance    = cv2.distanceTransform(free, cv2.DIST_L2, cv2.DIST_MASK_PRECISE)
+            start       = top + row - r0
+            clearance[row:row+band] = np.minimum(distance[start:start + min(band, height - row), 1:width+1], 255)
+        if parms['occupancyCache']:
+            clearance.flush()
+            del clearance
+            os.replace(cache + ".tmp", cache)
+            clearance   = np.load(cache, mmap_mode='r')
+        self.clearance  = clearance
+
+    #==============================================================================
+    #
+    # Likelihood field sensor model
+    #
+    # The distance from every pixel to the closest wall is computed once.
+    # A particle is scored by projecting the robot's lidar endpoints from the
+    # particle position and looking up how far each endpoint is from a wall.
+    # The cost per beam that hit is a table lookup, independent of the beam
+    # range. A beam that did not hit is checked with a lookup every 2 pixels.
+    #
+    #==============================================================================
+    def __createDistanceField(self):
+        print("Creating distance field")
+        free                = np.where(self.__occupied, 0, 255).astype(np.uint8)
+        self.distance_field = cv2.distanceTransform(free, cv2.DIST_L2, cv2.DIST_MASK_PRECISE)
+
+    # Returns an N vector of weights in [0,1] for particles at xs, ys given the
+    # robot's lidar samples. A beam that hit a wall is scored by the distance
+    # from its endpoint to the closest wall. A beam that did not hit a wall
+    # (max distance) is scored by how much shorter the range predicted from
+    # the particle is: the beam is sampled every 2 pixels and the first
+    # sample within 1 pixel of a wall, or outside the arena, is the predicted
+    # hit. Without that, a pose where only a few beams hit could score high.
+    # Particles inside a wall or outside the arena get weight 0.
+    def scoreLikelihood(self, xs, ys, robot_samples, heading, sigma=None):
+        if sigma is None:
+            sigma = self.parms['likelihoodSigmaNoise']
+        xs          = np.asarray(xs, dtype=float).reshape(-1)
+        ys          = np.asarray(ys, dtype=float).reshape(-1)
+        n           = len(xs)
+        weights     = np.zeros(n)
+        z           = np.asarray(robot_samples, dtype=float)
+        max_range   = self.lidar_max_distance-1
+        hits        = np.nonzero(z < max_range)[0]
+        misses      = np.nonzero(z >= max_range)[0]
+        if n == 0 or len(hits) == 0: return weights
+        Instrumentation.count('likelihoodEndpoints', n * len(hits))
+        heading     = np.broadcast_to(np.asarray(heading, dtype=float), (n,))
+        s           = np.trunc(heading/((2 * math.pi)/self.lidar_samples)).astype(np.intp)
+        angle       = ((hits + s[:,None]) % self.lidar_samples) * ((2 * math.pi)/self.lidar_samples)
+        ex          = np.trunc(xs[:,None] + np.round(z[hits] * np.cos(angle))).astype(np.intp)
+        ey          = np.trunc(ys[:,None] + np.round(z[hits] * np.sin(angle))).astype(np.intp)
+        score       = np.exp(-(self.__wallDistance(ex, ey, np.inf) ** 2) / (2.0 * sigma ** 2))
+        if len(misses):
+            Instrumentation.count('likelihoodMisses', n * len(misses))
+            beams   = (misses + s[:,None]) % self.lidar_samples
+            steps   = np.arange(2, max_range, 2)
+            ex      = np.trunc(xs).astype(np.intp)[:,None,None] + self.scan_dx[:,steps][beams]
+            ey      = np.trunc(ys).astype(np.intp)[:,None,None] + self.scan_dy[:,steps][beams]
+            near    = self.__wallDistance(ex, ey, 0.0) <= 1
+            predicted = np.where(near.any(axis=2), steps[near.argmax(axis=2)], max_range)
+            score   = np.concatenate((score, np.exp(-((max_range - predicted) ** 2) / (2.0 * sigma ** 2))), axis=1)
+        weights     = score.mean(axis=1)
+        weights[self.checkXYBatch(xs, ys) | (xs < 0) | (ys < 0)] = 0.0
+        return weights
+
+    # Distance field lookup, outside for the pixels outside the arena
+    def __wallDistance(self, x, y, outside):
+        inside      = (x >= 0) & (x < self.width) & (y >= 0) & (y < self.height)
+        dist        = self.distance_field[np.where(inside, y, 0), np.where(inside, x, 0)]
+        return np.where(inside, dist, outside)
 
+    #==============================================================================
+    #
+    # Valid regions - where initial particles are placed
+    #
+    # Every arenaRegion grid point that is open, and that has a wall within
+    # lidarMaxDistance on one of 36 rays (every 10 degrees), so the lidar can
+    # see something from it. The test is a dilation of the occupancy mask by
+    # the ring of ray ends, sampled only at the grid points: one gather of
+    # grid points x ring offsets. Edges are handled as in CheckXY.
+    #
+    # The result only depends on the occupancy, arenaRegion and
+    # lidarMaxDistance, so it is cached in cacheDirectory (regionCache).
+    #
+    #==============================================================================
     def __createValidRegions(self, parameters):
-        #  (0,0)1 2(?,0)
-        #  (0,?)4 8(?,?)
-                               # 1 = open, 0 = collision
-        self.cad = [( -1,-1 ), # 0000 - do not place
-                    (  0,0  ), # 0001 - put into 1
-                    (  1,0  ), # 0010 - put into 2
-                    (0.5,0  ), # 0011 - between 1-2
-                    (  0,1  ), # 0100 - put into 4
-                    (  0,0.5), # 0101 - between 1-4
-                    ( -1,-1 ), # 0110 - do not place
-                    (  0,0  ), # 0111 - put into 1
-                    (  1,1  ), # 1000 - put into 8
-                    ( -1,-1 ), # 1001 - do not place
-                    ( -1,-1 ), # 1010 - do not place
-                    (  1,0  ), # 1011 - put into 2
-                    (0.5,1  ), # 1100 - between 4-8
-                    (  0,1  ), # 1101 - put into 4
-                    (  1,1  ), # 1110 - put into 8
-                    (0.5,0.5)] # 1111 - put into middle
-        self.outer_scan = [self.__boundary(self.lidar_max_distance,angle) \
-                for angle in range(0,360,10)]
-        self.valid_regions = self.__getValidRegions()
+        filename = os.path.join(parameters['cacheDirectory'], "regions_%s_%d_%d.npy" % \
+                (self.map_hash[:16], self.region, self.lidar_max_distance))
+        if parameters['regionCache'] and os.path.exists(filename):
+            self.valid_regions = np.load(filename)
+        else:
+            self.valid_regions = self.__getValidRegions()
+            if parameters['regionCache']:
+                os.makedirs(parameters['cacheDirectory'], exist_ok=True)
+                temp = filename + ".tmp.npy"
+                np.save(temp, self.valid_regions)
+                os.replace(temp, filename)
+        print("Number of valid regions: "+str(len(self.valid_regions)))
 
     def __createLidarScan(self, parms):
         self.scan_points =  [ ([0] * self.lidar_max_distance) \
@@ -119,34 +573,31 @@ class Arena:
                 y = d * math.sin(scan_angle)
                 self.scan_points[s][d] = (int(round(x)),int(round(y)))
             scan_angle = scan_angle + angle_adder
+        # scan_points as arrays for readLidarBatch
+        table               = np.array(self.scan_points, dtype=np.intp)
+        self.scan_dx        = table[:,:,0]
+        self.scan_dy        = table[:,:,1]
 
     # If any portion of the region is valid, add it to self.valid_regions
     #  (0,0)1 2(?,0)
     #  (0,?)4 8(?,?)
+    # Returns an N x 2 array of (x, y)
     def __getValidRegions(self):
         print("Finding valid regions")
-        i = 0
-        x = 0
-        y = 0
-        valid_regions = []
-        while(1):
-            if not self.CheckXY(x,y): # center is open
-                valid = False
-                for offset in self.outer_scan:
-                    xa = min(offset[0]+x, self.width)
-                    ya = min(offset[1]+y, self.height)
-                    if self.CheckXY(xa,ya): # Scan hit wall
-                        valid = True
-                        break
-                if valid:
-                    cv2.circle(self.__image, (x, y), 1, (0,0,255), -1)
-                    valid_regions.append((x, y))
-            x = int((i * self.region) % self.width)
-            y = int((i * self.region) / self.width)*self.region
-            i += 1
-            if y >= self.height: break
-        print("Number of valid regions: "+str(len(valid_regions)))
-        return valid_regions
+        # Grid points in scan order, x = i*region mod width
+        i       = np.arange(-(-self.height // self.region) * -(-self.width // self.region) + 1)
+        x       = (i * self.region) % self.width
+        y       = (i * self.region) // self.width * self.region
+        x, y    = x[y < self.height], y[y < self.height]
+        ring    = np.array([self.__boundary(self.lidar_max_distance, angle) \
+                    for angle in range(0,360,10)], dtype=np.intp)
+        valid   = ~self.__occupied[y, x]
+        # The ray ends are clamped to the right/bottom edge
+        for b in range(0, len(x), 65536):
+            xa  = np.minimum(x[b:b+65536,None] + ring[:,0], self.width)
+            ya  = np.minimum(y[b:b+65536,None] + ring[:,1], self.height)
+            valid[b:b+65536] &= self.checkXYBatch(xa, ya).any(axis=1)
+        return np.stack((x[valid], y[valid]), axis=1)
 
     def __boundary(self,d,heading):
             x = d * math.cos(heading*(2*math.pi/360))
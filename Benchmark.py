@@ -0,0 +1,350 @@
+# Experiments in robot localization using particle filters (algorithm and simulator)
+# Copyright (C) <2021>  Eric Gregori
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import contextlib
+import getopt
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time                         # Used for performance measuring
+import cv2
+import numpy as np
+import Algorithm as alg
+import Arena
+import Configuration as Config
+import LidarBotModel as model
+import RobotServer as rs
+
+#==============================================================================
+#
+# Benchmark suite for the localization hot paths
+#
+#   For every arena and lidarSamples:
+#       arena_init          Arena() without the scan table (valid regions,
+#                           occupancy), best of repeat
+#       arena_load_cache    Arena() with the occupancy grid and valid regions
+#                           from the cache
+#       arena_init_table    Arena() building the scan table, once, cold cache
+#       arena_load_table    Arena() loading the cached scan table
+#                           (the scan table benchmarks are skipped with -n)
+#       read_lidar          one Arena.readLidar call
+#   and for every number of particles:
+#       read_lidar_batch    Arena.readLidarBatch of all particles
+#       read_lidar_table    the same from the scan table
+#       place               ParticleSet.place of all particles (Particle.place)
+#       move                ParticleSet.move of all particles (Particle.move)
+#       weights_loop        per particle np.corrcoef (the old weighing)
+#       weights             batched correlationWeights
+#       heading_search      headingSearch, the weights at every heading
+#       reset               ParticleFilter() - __resetParticles
+#       reset_pyramid       the same with globalLocalization 'pyramid'
+#       update              one ParticleFilter.update, average over a
+#                           recorded simulated robot run
+#
+#   Arenas are image files or synthetic:N, a generated N x N arena of rooms.
+#   Times are seconds, written as JSON (-o). With -b the results are compared
+#   against a stored baseline and a time more than threshold (-t) slower is
+#   reported as a regression, the exit status is then 1.
+#
+#==============================================================================
+MIN_DELTA       = 0.0001            # Seconds, smaller differences are noise
+
+#==============================================================================
+#
+# usage
+#
+#==============================================================================
+def usage():
+    print("!ERROR! Illegal parameter")
+    print("Optional strings: [-a arenaFilename or synthetic:N, repeat for more arenas]")
+    print("                  [-o results JSON] [-b baseline JSON]")
+    print("Optional lists: [-p numberOfParticles,...] [-l lidarSamples,...]")
+    print("Optional ints: [-r repeat] [-i update iterations] [-t regression threshold, 0.1 = 10%]")
+    print("Optional Flags: [-n no scan table benchmarks]")
+    sys.exit(-1)
+
+# Best of repeat runs of function, setup runs before each run and is not timed
+def timeIt(function, repeat, setup=None):
+    best = float('inf')
+    for r in range(repeat):
+        if setup is not None: setup()
+        start_time = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start_time)
+    return best
+
+# Run function without its console output
+def quiet(function):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return function()
+
+#==============================================================================
+#
+# Synthetic arena - size x size, walls are white
+#
+#   A grid of rooms with a door in every wall and a few obstacles, generated
+#   from a fixed seed so every run and every machine sees the same arena.
+#
+#==============================================================================
+def syntheticArena(size, directory):
+    filename = os.path.join(directory, "synthetic_%d.png" % size)
+    if os.path.exists(filename): return filename
+    rng     = np.random.default_rng(size)
+    image   = np.zeros((size, size, 3), dtype=np.uint8)
+    room    = max(size // 4, 64)
+    door    = 20
+    white   = (255, 255, 255)
+    cv2.rectangle(image, (0, 0), (size-1, size-1), white, 4)
+    for wall in range(room, size - room//2, room):
+        cv2.line(image, (wall, 0), (wall, size-1), white, 3)
+        cv2.line(image, (0, wall), (size-1, wall), white, 3)
+        for start in range(0, size, room):
+            gap = start + int(rng.integers(10, max(11, room - door - 10)))
+            cv2.line(image, (wall, gap), (wall, gap + door), (0, 0, 0), 3)
+            cv2.line(image, (gap, wall), (gap + door, wall), (0, 0, 0), 3)
+    for obstacle in range((size // room) ** 2):
+        x, y = rng.integers(10, size - 30, size=2)
+        cv2.rectangle(image, (int(x), int(y)), (int(x) + 12, int(y) + 12), white, -1)
+    os.makedirs(directory, exist_ok=True)
+    cv2.imwrite(filename, image)
+    return filename
+
+def arenaFilename(name, parameters):
+    if name.startswith("synthetic:"):
+        return syntheticArena(int(name.split(":")[1]), parameters['cacheDirectory'])
+    return name
+
+#==============================================================================
+#
+# Robot run - init and update messages from the simulated robot
+#
+#==============================================================================
+def robotRun(parameters, iterations):
+    parms = dict(parameters)
+    random.seed(0)
+    server = quiet(lambda: rs.RobotServer(parms))
+    run = []
+    for i in range(iterations + 1):
+        quiet(lambda: server.getDataFromRobot(parms, []))
+        run.append((parms['robotHeading'], parms.get('robotDistance', 0), \
+                    list(parms['robotLidarData']), parms['robotValidLidar']))
+    return run
+
+def setRobot(parms, message):
+    (parms['robotHeading'], parms['robotDistance'], parms['robotLidarData'], \
+        parms['robotValidLidar']) = message
+
+#==============================================================================
+#
+# Benchmarks
+#
+#==============================================================================
+# cache is an empty cacheDirectory
+def benchArena(parameters, cache, scan_table, repeat):
+    results = dict()
+    parms = dict(parameters)
+    results['arena_init'] = timeIt(lambda: quiet(lambda: Arena.Arena(dict(parms, regionCache=False, occupancyCache=False))), repeat)
+    parms.update(regionCache=True, occupancyCache=True, cacheDirectory=cache)
+    quiet(lambda: Arena.Arena(dict(parms)))
+    results['arena_load_cache'] = timeIt(lambda: quiet(lambda: Arena.Arena(dict(parms))), repeat)
+    if scan_table:
+        parms.update(scanTable=True)
+        results['arena_init_table'] = timeIt(lambda: quiet(lambda: Arena.Arena(dict(parms))), 1)
+        results['arena_load_table'] = timeIt(lambda: quiet(lambda: Arena.Arena(dict(parms))), repeat)
+    arena = parameters['arena']
+    rng = np.random.default_rng(0)
+    regions = np.array(arena.valid_regions)
+    positions = regions[rng.integers(len(regions), size=1000)]
+    samples = [0] * parameters['lidarSamples']
+    def readLidar():
+        for x, y in positions:
+            arena.readLidar(x, y, samples, heading=0.0)
+    results['read_lidar'] = timeIt(readLidar, repeat) / len(positions)
+    return results
+
+def benchParticles(parameters, table_arena, particles, run, repeat):
+    results = dict()
+    parms = dict(parameters)
+    arena = parms['arena']
+    rng = np.random.default_rng(0)
+    regions = np.array(arena.valid_regions)
+    pick = regions[rng.integers(len(regions), size=particles)]
+    xs, ys = pick[:,0], pick[:,1]
+    heading = run[0][0]
+    results['read_lidar_batch'] = timeIt(lambda: arena.readLidarBatch(xs, ys, heading), repeat)
+    if table_arena is not None:
+        results['read_lidar_table'] = timeIt(lambda: table_arena.readLidarBatch(xs, ys, heading), repeat)
+
+    setRobot(parms, run[1])
+    pset = model.ParticleSet(parms, rng=np.random.default_rng(0))
+    pset.add(xs, ys, weigh=False)
+    index = np.arange(particles)
+    results['place'] = timeIt(lambda: pset.place(index, xs, ys), repeat)
+    results['move'] = timeIt(pset.move, repeat, setup=lambda: pset.place(index, xs, ys))
+
+    robot_samples = np.array(run[1][2])
+    samples = pset.samples
+    def perParticle():
+        weights = np.zeros(particles)
+        for i in range(particles):
+            result = np.corrcoef(robot_samples, np.array(samples[i]))
+            if not np.isnan(result[0][1]):
+                weights[i] = max(result[0][1], 0)
+        return weights
+    with np.errstate(divide='ignore', invalid='ignore'):
+        results['weights_loop'] = timeIt(perParticle, repeat)
+    results['weights'] = timeIt(lambda: model.correlationWeights(robot_samples, samples), repeat)
+    results['heading_search'] = timeIt(lambda: model.headingSearch(robot_samples, samples), repeat)
+
+    parms['numberOfParticles'] = particles
+    setRobot(parms, run[0])
+    results['reset'] = timeIt(lambda: quiet(lambda: alg.ParticleFilter(parms)), repeat)
+    pyramid = dict(parms, globalLocalization='pyramid')
+    results['reset_pyramid'] = timeIt(lambda: quiet(lambda: alg.ParticleFilter(pyramid)), repeat)
+
+    def update():
+        setRobot(parms, run[0])
+        pf = quiet(lambda: alg.ParticleFilter(parms))
+        elapsed_time = 0.0
+        for message in run[1:]:
+            setRobot(parms, message)
+            start_time = time.perf_counter()
+            quiet(lambda: pf.update(parms, []))
+            elapsed_time += time.perf_counter() - start_time
+        pf.close()
+        return elapsed_time
+    results['update'] = min(update() for r in range(repeat)) / (len(run) - 1)
+    return results
+
+def runSuite(parameters, arenas, particle_counts, lidar_samples, repeat, iterations, scan_table):
+    results = dict()
+    for name in arenas:
+        for samples in lidar_samples:
+            parms = dict(parameters)
+            parms['arenaFilename']      = arenaFilename(name, parameters)
+            parms['lidarSamples']       = samples
+            parms['robotTurnOffset']    = int(samples/4)
+            parms['arena']              = quiet(lambda: Arena.Arena(parms))
+            case = "%s/s%d" % (name, samples)
+            print(case)
+            cache = tempfile.mkdtemp()
+            table_arena = None
+            try:
+                for key, value in benchArena(parms, cache, scan_table, repeat).items():
+                    results[case + "/" + key] = value
+                if scan_table:
+                    table_parms = dict(parms, scanTable=True, cacheDirectory=cache)
+                    table_arena = quiet(lambda: Arena.Arena(table_parms))
+                run = robotRun(parms, iterations)
+                for particles in particle_counts:
+                    print(case + "/p%d" % particles)
+                    for key, value in benchParticles(parms, table_arena, particles, run, repeat).items():
+                        results[case + "/p%d/" % particles + key] = value
+            finally:
+                shutil.rmtree(cache)
+    return results
+
+# Returns the number of regressions
+def compare(results, baseline, threshold):
+    regressions = 0
+    print("%-50s %12s %12s %8s" % ("benchmark", "baseline", "now", "ratio"))
+    for key, value in results.items():
+        if key not in baseline:
+            print("%-50s %12s %12.6f" % (key, "-", value))
+            continue
+        ratio = value / baseline[key] if baseline[key] > 0 else float('inf')
+        flag = ""
+        if value > baseline[key] * (1 + threshold) and value - baseline[key] > MIN_DELTA:
+            flag = "REGRESSION"
+            regressions += 1
+        print("%-50s %12.6f %12.6f %8.2f %s" % (key, baseline[key], value, ratio, flag))
+    return regressions
+
+def printResults(results):
+    for key, value in results.items():
+        print("%-50s %12.6f" % (key, value))
+
+#==============================================================================
+#
+# main
+#
+#==============================================================================
+def main(argv):
+    parameters = dict()
+    config = Config.Configuration(parameters)
+    parameters['initialWeightThres'] = 0.8
+    arenas = []
+    particle_counts = [500, 2000]
+    lidar_samples = [36, 72]
+    repeat = 3
+    iterations = 10
+    output = None
+    baseline = None
+    threshold = 0.1
+    scan_table = True
+    try:
+        opts, args = getopt.getopt(argv, "na:p:l:r:i:o:b:t:")
+    except getopt.GetoptError:
+        usage()
+    try:
+        for opt, arg in opts:
+            if opt in ("-n"):
+                scan_table      = False
+            elif opt in ("-a"):
+                arenas.append(arg)
+            elif opt in ("-p"):
+                particle_counts = [int(p) for p in arg.split(",")]
+            elif opt in ("-l"):
+                lidar_samples   = [int(s) for s in arg.split(",")]
+            elif opt in ("-r"):
+                repeat          = int(arg)
+            elif opt in ("-i"):
+                iterations      = int(arg)
+            elif opt in ("-o"):
+                output          = arg
+            elif opt in ("-b"):
+                baseline        = arg
+            elif opt in ("-t"):
+                threshold       = float(arg)
+    except ValueError:
+        usage()
+    if not arenas:
+        arenas = ["floorplan.png", "synthetic:256", "synthetic:512", "synthetic:1024"]
+
+    results = runSuite(parameters, arenas, particle_counts, lidar_samples, repeat, iterations, scan_table)
+    print()
+    if output is not None:
+        with open(output, "w") as fp:
+            json.dump({'machine': platform.platform(), 'python': platform.python_version(),
+                       'numpy': np.__version__, 'repeat': repeat, 'iterations': iterations,
+                       'scanTable': scan_table,
+                       'results': results}, fp, indent=1)
+        print("Results: "+output)
+    if baseline is None:
+        printResults(results)
+        return 0
+    with open(baseline) as fp:
+        regressions = compare(results, json.load(fp)['results'], threshold)
+    print("%d regressions" % regressions)
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
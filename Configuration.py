@@ -18,19 +18,77 @@ class Configuration:
     def __init__(self, parameters):
         # Simulation parameters
         parameters['verbose']                         = False
+        parameters['randomSeed']                      = None     # Seed for the filter random numbers
         parameters['arenaRegion']                     = 10
+        parameters['cacheDirectory']                  = 'cache'  # Arena preprocessing cache
+        parameters['scanTable']                       = False    # Precomputed lidar scan per cell
+        parameters['scanTableStride']                 = 1        # Scan table cell size in pixels
+        parameters['scanCacheSize']                   = 4096     # Recent particle scans kept, 0 = off
+        parameters['regionCache']                     = True     # Cache the valid regions
+        parameters['occupancyCache']                  = True     # Cache the occupancy grid
 
         # Particle filter parameters
         parameters['numberOfParticles']               = 0
+        parameters['workers']                         = 0        # Worker processes, 0 = single process
+        parameters['workerShardSize']                 = 256      # Particles per worker task
+        parameters['sensorModel']                     = 'raycast' # 'raycast' - correlate ray cast scans
+                                                                  # 'likelihood' - distance field lookup
+        parameters['weightModel']                     = 'correlation' # raycast weights: 'correlation' or
+                                                                      # 'gaussian' beam likelihood
+        parameters['headingSource']                   = 'magnetometer' # 'magnetometer' - robotHeading
+                                                                       # 'search' - per particle, from the scan
+        parameters['headingSearchWindow']             = 0 # search: beams either side after a move,
+                                                          # 0 holds the heading until the robot turns
+        parameters['searchKeepThreshold']             = 0.95 # search: keep weight, the best heading
+                                                             # inflates the weights
+        parameters['redistributeTries']               = 50   # search: placement rounds before giving up
+        parameters['resampleMode']                    = 'redistribute' # 'redistribute' - place dump particles
+                                                                       # next to keep particles
+                                                                       # 'lowvariance' - systematic resampling
+        parameters['globalLocalization']              = 'exhaustive' # or 'pyramid', coarse to fine
+        parameters['pyramidLevels']                   = 1        # pyramid: coarse levels, 2^n downsampling
+        parameters['pyramidHypotheses']               = [100]    # pyramid: cells kept per level, coarse first
+        parameters['resampleJitter']                  = 1.0      # lowvariance position jitter sigma (pixels)
+        parameters['kldSampling']                     = False    # Adapt the particle count (needs lowvariance)
+        parameters['kldMinParticles']                 = 100
+        parameters['kldMaxParticles']                 = 5000
+        parameters['kldEpsilon']                      = 0.05     # Max error between sampled and true belief
+        parameters['kldDelta']                        = 0.01     # 1 - confidence in kldEpsilon
+        parameters['kldBinSize']                      = 10       # Histogram bin size in pixels
+        parameters['trackingMode']                    = False    # Local work once converged (-t)
+        parameters['trackingWeight']                  = 0.95     # Enter tracking above this average weight
+        parameters['trackingSpread']                  = 10       # and below this prediction radius (pixels)
+        parameters['trackingLostWeight']              = 0.8      # Leave tracking below this average weight
+        parameters['trackingWindow']                  = 100      # Re-localize within +/- pixels of the estimate
+        parameters['scanMatching']                    = False    # Refine the prediction by scan matching (-S)
+        parameters['scanMatchWindow']                 = 8        # Search +/- pixels around the prediction
+        parameters['scanMatchStep']                   = 4        # Coarse search step in pixels
+        parameters['scanMatchSpread']                 = 6        # Redistribute within this around the match
+        parameters['scanMatchMargin']                 = 0.02     # The match must beat the prediction by this
+        parameters['scanMatchKeep']                   = 0.5      # Dump particles kept around the keep particles
+
+        # Data logger parameters (-d dataFilename)
+        parameters['logFlushInterval']                = 10       # Records written per flush
+        parameters['logParticles']                    = False    # Also log every particle (-l)
 
         # Display parameters
         parameters['plotGraphics']                    = False
         parameters['plotSamples']                     = False
         parameters['displayTextX']                    = 50
         parameters['displayTextY']                    = 50
+        parameters['renderMode']                      = 'sync'   # 'sync' or 'background' writer thread
+        parameters['renderQueueSize']                 = 8        # background: frames waiting to be written
+        parameters['renderPolicy']                    = 'drop'   # background, queue full: 'drop' or 'block'
+        parameters['renderFrameSkip']                 = 1        # Render every Nth frame
+        parameters['displayOutput']                   = 'jpeg'   # 'jpeg' file per frame or 'video' (-e)
+        parameters['videoFps']                        = 1
+        parameters['videoFrameStep']                  = 1        # Encode every Nth frame
+        parameters['videoScale']                      = 1.0      # Frame size scale
+        parameters['videoFourcc']                     = 'mp4v'
 
         # Robot model parameters
         parameters['measurementSigmaNoise']           = 2.0      # Sigma for measurement noise
+        parameters['likelihoodSigmaNoise']            = 3.0      # Sigma for the likelihood sensor model
         parameters['headingSigmaNoise']               = 0.15     # Sigma for turning noise
         parameters['distanceSigmaNoise']              = 0.003    # Sigma for distance noise
 
@@ -40,6 +98,16 @@ class Configuration:
         parameters['distanceToPixel']                 = 3        # Robot count/pixel ratio
                                                                  # So if the robot moves 1000 counts
                                                                  # for every 10 pixels, this should be 10
+        # Session parameters, one session per robot (-n robots)
+        parameters['robots']                          = 1
+        parameters['sessionPolicy']                   = 'fair'   # 'fair' or 'roundrobin', or a list per robot
+        parameters['sessionShare']                    = 1.0      # 'fair' time share, or a list per robot
+
+        # Robot server parameters (-s serverIP)
+        parameters['serverPort']                      = 5000
+        parameters['serverSlots']                     = 4        # Frame buffers between server and filter
+        parameters['serverTimeout']                   = 1.0      # Seconds to wait for a frame, then idle
+
         # Simulated robot parameters
         parameters['robotDistBetUpdates']             = 21       # The simulated robot moves X pixels for each update
         parameters['robotTurnOffset']                 = int(parameters['lidarSamples']/4)
@@ -58,9 +126,18 @@ class Configuration:
             print("iterations          = "+str(parameters['iterations']))
             if parameters['plotGraphics']: 
                 print("Graphics output enabled")
+            if parameters['displayOutput'] == 'video':
+                print("videoFilename       = "+parameters['videoFilename'])
             if parameters['plotSamples']: 
                 print("Sample plotting output enabled")
             print( "Initial weight threshold = %f"%parameters['initialWeightThres'])
+            print("Sensor model        = "+parameters['sensorModel'])
+            if 'replayFilename' in parameters:
+                print("replayFilename      = "+parameters['replayFilename'])
+            if 'recordFilename' in parameters:
+                print("recordFilename      = "+parameters['recordFilename'])
+            if parameters['workers']:
+                print("Workers             = "+str(parameters['workers']))
         except KeyError:
             usage = True
         print()
@@ -71,8 +148,57 @@ class Configuration:
         if parameters['plotSamples'] and not 'outputPath' in parameters:
             print("!ERROR! -o must be specified with -m")
             usage = True
-        if parameters['plotGraphics'] and not 'outputPath' in parameters:
+        if parameters['plotGraphics'] and not 'outputPath' in parameters and \
+                parameters['displayOutput'] == 'jpeg':
             print("!ERROR! -o must be specified with -g")
             usage = True
+        if parameters['sensorModel'] not in ('raycast', 'likelihood'):
+            print("!ERROR! sensorModel must be raycast or likelihood")
+            usage = True
+        if parameters['resampleMode'] not in ('redistribute', 'lowvariance'):
+            print("!ERROR! resampleMode must be redistribute or lowvariance")
+            usage = True
+        if parameters['kldSampling'] and parameters['resampleMode'] != 'lowvariance':
+            print("!ERROR! kldSampling requires resampleMode lowvariance")
+            usage = True
+        if parameters['renderMode'] not in ('sync', 'background'):
+            print("!ERROR! renderMode must be sync or background")
+            usage = True
+        if parameters['renderPolicy'] not in ('drop', 'block'):
+            print("!ERROR! renderPolicy must be drop or block")
+            usage = True
+        policies = parameters['sessionPolicy']
+        if not isinstance(policies, (list, tuple)): policies = [policies]
+        if any(p not in ('fair', 'roundrobin') for p in policies):
+            print("!ERROR! sessionPolicy must be fair or roundrobin")
+            usage = True
+        if parameters['weightModel'] not in ('correlation', 'gaussian'):
+            print("!ERROR! weightModel must be correlation or gaussian")
+            usage = True
+        if parameters['headingSource'] not in ('magnetometer', 'search'):
+            print("!ERROR! headingSource must be magnetometer or search")
+            usage = True
+        if parameters['headingSource'] == 'search' and parameters['sensorModel'] != 'raycast':
+            print("!ERROR! headingSource search requires sensorModel raycast")
+            usage = True
+        if parameters['headingSearchWindow'] < 0:
+            print("!ERROR! headingSearchWindow must be >= 0")
+            usage = True
+        if parameters['redistributeTries'] < 1:
+            print("!ERROR! redistributeTries must be >= 1")
+            usage = True
+        if not 0.0 <= parameters['scanMatchKeep'] <= 1.0:
+            print("!ERROR! scanMatchKeep must be between 0 and 1")
+            usage = True
+        if parameters['globalLocalization'] not in ('exhaustive', 'pyramid'):
+            print("!ERROR! globalLocalization must be exhaustive or pyramid")
+            usage = True
+        hypotheses = parameters['pyramidHypotheses']
+        if isinstance(hypotheses, (list, tuple)) and len(hypotheses) != parameters['pyramidLevels']:
+            print("!ERROR! pyramidHypotheses needs one value per pyramid level")
+            usage = True
+        if 'replayFilename' in parameters and 'serverIP' in parameters:
+            print("!ERROR! -P and -s can not be used together")
+            usage = True
         return usage
 
@@ -14,13 +14,175 @@
 #    You should have received a copy of the GNU General Public License
 #    along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import math
+import time
+import numpy as np
 import matplotlib.pyplot as plt
 
+#==============================================================================
+#
+# DataLogger - binary log of the filter state
+#
+# The log is a .npy file of fixed size records, one per robot per iteration,
+# appended in chunks of logFlushInterval records. After each chunk the record
+# count in the .npy header is updated and the file is flushed, so the log
+# can be loaded (memory mapped) while it is being written:
+#
+#   records, particles = DataLogger.loadLog(filename)
+#   records['TT'], records['robotLidar'][i], ...
+#
+# With logParticles, every particle is also appended to
+# dataFilename.particles.npy (iteration, robot, x, y, weight).
+#
+#==============================================================================
+MSG_TYPES       = {'init': 1, 'update': 2}
+HEADER_LENGTH   = 512               # Room for any record count in the .npy header
+
+def recordType(lidar_samples):
+    return np.dtype([('iteration',      '<u4'),
+                     ('robot',          '<u2'),
+                     ('msgType',        'u1'),
+                     ('robotValidLidar','?'),
+                     ('time',           '<f8'),     # Seconds since the logger started
+                     ('robotX',         '<f4'),     # Ground truth, NaN if unknown
+                     ('robotY',         '<f4'),
+                     ('robotHeading',   '<f4'),
+                     ('robotDistance',  '<f4'),
+                     ('robotLidar',     '<u2', (lidar_samples,)),
+                     ('predictionX',    '<i4'),
+                     ('predictionY',    '<i4'),
+                     ('predictionR',    '<i4'),
+                     ('avgWeight',      '<f4'),
+                     ('particles',      '<u4'),
+                     ('keep',           '<u4'),
+                     ('MT',             '<f4'),     # NaN if the phase did not run
+                     ('PT',             '<f4'),
+                     ('TT',             '<f4')])
+
+PARTICLE_TYPE = np.dtype([('iteration', '<u4'), ('robot', '<u2'), ('x', '<i4'), ('y', '<i4'), ('weight', '<f4')])
+
+# Returns (records, particles) memory mapped, particles is None if not logged
+def loadLog(filename):
+    records = np.load(filename, mmap_mode='r')
+    particles = None
+    try:
+        particles = np.load(filename + ".particles.npy", mmap_mode='r')
+    except FileNotFoundError:
+        pass
+    return records, particles
+
+#==============================================================================
+#
+# LogFile - append only .npy file of records
+#
+#==============================================================================
+class LogFile:
+
+    def __init__(self, filename, dtype, chunk):
+        self.dtype      = dtype
+        self.count      = 0
+        self.chunk      = np.zeros(max(1, chunk), dtype=dtype)
+        self.used       = 0
+        self.fp         = open(filename, "wb")
+        self.__writeHeader()
+
+    def __writeHeader(self):
+        header = repr({'descr': np.lib.format.dtype_to_descr(self.dtype),
+                       'fortran_order': False,
+                       'shape': (self.count,)})
+        header = header.ljust(HEADER_LENGTH - 10 - 1) + "\n"
+        self.fp.seek(0)
+        self.fp.write(np.lib.format.magic(1, 0))
+        self.fp.write(np.uint16(len(header)).astype('<u2').tobytes())
+        self.fp.write(header.encode('latin1'))
+        self.fp.seek(0, 2)
+
+    # Returns the next record to fill in, zeroed. The chunk rows are reused
+    # after a flush, a field that is not filled in must not keep the value
+    # of an earlier record.
+    def next(self):
+        if self.used == len(self.chunk): self.flush()
+        self.used += 1
+        self.chunk[self.used - 1] = 0
+        return self.chunk[self.used - 1]
+
+    def append(self, records):
+        start = 0
+        while start < len(records):
+            if self.used == len(self.chunk): self.flush()
+            part = records[start:start + len(self.chunk) - self.used]
+            self.chunk[self.used:self.used + len(part)] = part
+            self.used += len(part)
+            start += len(part)
+
+    def flush(self):
+        if self.used == 0: return
+        self.fp.write(self.chunk[:self.used].tobytes())
+        self.count += self.used
+        self.used = 0
+        self.__writeHeader()
+        self.fp.flush()
+
+    def close(self):
+        self.flush()
+        self.fp.close()
+
 class DataLogger:
 
+    def __init__(self):
+        self.log            = None
+        self.particle_log   = None
+
     def startDataLogger(self, parms):
-        self.fp = open(parms['dataFilename'], "w")
-        fp.write("rx, ry, ")
+        print("Logging to: "+parms['dataFilename'])
+        self.start_time     = time.perf_counter()
+        self.log            = LogFile(parms['dataFilename'], recordType(parms['lidarSamples']), \
+                                parms['logFlushInterval'])
+        if parms['logParticles']:
+            self.particle_log = LogFile(parms['dataFilename'] + ".particles.npy", PARTICLE_TYPE, \
+                                parms['logFlushInterval'] * 1000)
+
+    # Log one filter iteration of robot. elapsed_time is the total iteration time (TT).
+    def logIteration(self, parms, robot, iteration, state, elapsed_time):
+        if self.log is None: return
+        r = self.log.next()
+        r['iteration']          = iteration
+        r['robot']              = robot
+        r['msgType']            = MSG_TYPES.get(state, 0)
+        r['robotValidLidar']    = parms['robotValidLidar']
+        r['time']               = time.perf_counter() - self.start_time
+        (r['robotX'], r['robotY']) = parms['simulatedRobotPath'][-1] \
+                                    if parms.get('simulatedRobotPath') else (math.nan, math.nan)
+        r['robotHeading']       = parms['robotHeading']
+        r['robotDistance']      = parms.get('robotDistance', 0) if state == 'update' else 0
+        r['robotLidar']         = parms['robotLidarData']
+        r['TT']                 = elapsed_time
+        if 'pfObject' not in parms: return
+        pf = parms['pfObject']
+        (done, nump, avgw, keep, prediction) = pf.data
+        (r['predictionX'], r['predictionY'], r['predictionR']) = prediction
+        r['avgWeight']          = avgw
+        r['particles']          = nump
+        r['keep']               = keep
+        r['MT']                 = pf.timings.get('MT', math.nan) if state == 'update' else math.nan
+        r['PT']                 = pf.timings.get('PT', math.nan) if state == 'update' else math.nan
+        if self.particle_log is not None:
+            pset = pf.particles
+            particles = np.zeros(len(pset), dtype=PARTICLE_TYPE)
+            particles['iteration']  = iteration
+            particles['robot']      = robot
+            particles['x']          = pset.x
+            particles['y']          = pset.y
+            particles['weight']     = pset.weight
+            self.particle_log.append(particles)
+
+    def close(self):
+        if self.log is not None:
+            self.log.close()
+            self.log = None
+        if self.particle_log is not None:
+            self.particle_log.close()
+            self.particle_log = None
 
     def plotSamples(self, parms, filename):
         pf = parms['pfObject']
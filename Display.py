@@ -15,54 +15,152 @@
 #    along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import cv2
+import queue
+import threading
+import Instrumentation
+
+#==============================================================================
+#
+# snapshot - copy of what is needed to draw one frame
+#
+# The particle arrays are copied, the robot path is only appended to so the
+# list and its current length are kept.
+#
+#==============================================================================
+def snapshot(parms, filename, text_list, point):
+    snap = {'filename'  : filename,
+            'text'      : [field[0] for field in text_list if field[1]],
+            'point'     : point,
+            'particles' : None,
+            'path'      : parms.get('simulatedRobotPath', []),
+            'pathLength': len(parms.get('simulatedRobotPath', []))}
+    if 'pfObject' in parms:
+        pset = parms['pfObject'].particles
+        snap['particles'] = (pset.x.copy(), pset.y.copy(), pset.weight.copy())
+    return snap
 
 #==============================================================================
 #
 # display - Use openCV to display the data in files
 #
+# Display(parms, filename, text_list, point) draws and saves one frame.
+# Display(parms) only sets up, frames are drawn with draw(snapshot(...)).
+#
+# Display is a persistent renderer. The arena image is copied once into a
+# background layer with the valid regions drawn in red, and each new
+# segment of the robot path is drawn into it once. A new or shorter robot
+# path (the robot was placed again) restores the background from the
+# arena. The frame buffer is reused: the areas drawn over in the last frame
+# (particles, robot, prediction, text) are restored from the background
+# before the new frame is drawn, so the cost of a frame depends on the number
+# of particles, not on the length of the run.
+#
+# displayOutput 'jpeg'  - each frame is saved to filename.jpg
+#               'video' - frames are encoded into one videoFilename with
+#                         cv2.VideoWriter at videoFps. Only every
+#                         videoFrameStep frame is encoded, scaled by videoScale.
+#                         close() finishes the file.
+#
 #==============================================================================
 class Display:
 
-    def __init__(self, parms, filename, text_list, point):
-        self.text_list      = text_list
+    def __init__(self, parms, filename=None, text_list=None, point=None):
         self.robot_color    = (255,255,0)
         self.textx          = parms['displayTextX']
         self.texty          = parms['displayTextY']
-        self.__image        = parms['arena'].GetImage().copy()
-        self.__addText()
-        if 'pfObject' in parms:
-            self.__addParticles(parms['pfObject'], point)
-        if 'simulatedRobotPath' in parms:
-            self.__addRobot(parms['simulatedRobotPath'][-1])
-            self.__addLine(parms['simulatedRobotPath'])
-        self.__saveImage(filename)
+        self.__arena        = parms['arena'].GetImage().copy()
+        for (x, y) in parms['arena'].valid_regions:
+            cv2.circle(self.__arena, (int(x), int(y)), 1, (0,0,255), -1)
+        self.__background   = self.__arena.copy()
+        self.__image        = self.__background.copy()
+        self.__height, self.__width = self.__image.shape[:2]
+        self.__path         = None  # The robot path in the background
+        self.__path_drawn   = 0     # Path points already in the background
+        self.__dirty        = []    # Areas to restore, (x0, y0, x1, y1)
+        self.__frames       = 0
+        self.__video        = None
+        if parms['displayOutput'] == 'video':
+            self.__openVideo(parms)
+        if filename is not None:
+            self.draw(snapshot(parms, filename, text_list, point))
+
+    def draw(self, snap):
+        self.__frames += 1
+        if self.__video is not None and (self.__frames - 1) % self.video_step:
+            # Decimated, only keep the path up to date
+            self.__addLine(snap['path'], snap['pathLength'])
+            return
+        with Instrumentation.span('draw'):
+            self.__restore()
+            self.__addLine(snap['path'], snap['pathLength'])
+            self.__addText(snap['text'])
+            if snap['particles'] is not None:
+                self.__addParticles(snap['particles'], snap['point'])
+            if snap['pathLength'] > 0:
+                self.__addRobot(snap['path'][snap['pathLength']-1])
+        with Instrumentation.span('encode'):
+            self.__saveImage(snap['filename'])
+        Instrumentation.count('framesDrawn')
+
+    # Restore the areas drawn over in the last frame
+    def __restore(self):
+        area = 0
+        for (x0, y0, x1, y1) in self.__dirty:
+            area += (x1 - x0) * (y1 - y0)
+        if area > self.__width * self.__height / 2:
+            self.__image[...] = self.__background
+        else:
+            for (x0, y0, x1, y1) in self.__dirty:
+                self.__image[y0:y1, x0:x1] = self.__background[y0:y1, x0:x1]
+        self.__dirty = []
+
+    # Mark a square of radius r around x, y to be restored
+    def __markDirty(self, x, y, r):
+        x0 = max(0, x - r)
+        y0 = max(0, y - r)
+        x1 = min(self.__width, x + r + 1)
+        y1 = min(self.__height, y + r + 1)
+        if x0 < x1 and y0 < y1:
+            self.__dirty.append((x0, y0, x1, y1))
 
     def __colorMap(self, weight):
         if weight >= 0.9: return (0,255,0) # Green
         if weight < 0.5: return (0,0,255)  # Red
         return (0,255,255) # Yellow
 
-    def __addLine(self, points):
-        if len(points) > 1:
-            for i in range(len(points)-1):
-                cv2.line(self.__image,(points[i][0],points[i][1]),(points[i+1][0],points[i+1][1]),(128,128,128),2)
+    # Draw the new path segments into the background and the frame
+    def __addLine(self, points, length):
+        if points is not self.__path or length < self.__path_drawn:
+            # A new path, remove the old one
+            if self.__path_drawn > 1:
+                self.__background[...] = self.__arena
+                self.__image[...] = self.__background
+                self.__dirty = []
+            self.__path = points
+            self.__path_drawn = 0
+        for i in range(max(1, self.__path_drawn), length):
+            for image in (self.__background, self.__image):
+                cv2.line(image,(points[i-1][0],points[i-1][1]),(points[i][0],points[i][1]),(128,128,128),2)
+        self.__path_drawn = max(self.__path_drawn, length)
 
     def __addRobot(self, robotxy):
         cv2.circle(self.__image, robotxy, 6, self.robot_color, -1)
+        self.__markDirty(robotxy[0], robotxy[1], 7)
 
-    def __addParticles(self, pf, point):
+    def __addParticles(self, particles, point):
         # The robot mUST be the first particle because it needs to move first
-        for p in pf.particles:
-            color = self.__colorMap(p.weight)
-            cv2.circle(self.__image, (p.x, p.y), 4, color, -1)
+        for x, y, weight in zip(*particles):
+            color = self.__colorMap(weight)
+            cv2.circle(self.__image, (int(x), int(y)), 4, color, -1)
+            self.__markDirty(int(x), int(y), 5)
         if point[2] > 0:
             cv2.circle(self.__image, (point[0], point[1]), point[2], (255,0,255), 1)
+            self.__markDirty(point[0], point[1], point[2] + 1)
 
-    def __addText(self,):
+    def __addText(self, text_list):
         text = ""
-        for field in self.text_list:
-            if field[1]:
-                text += (field[0]+" ")
+        for field in text_list:
+            text += (field+" ")
         font = cv2.FONT_HERSHEY_SIMPLEX
         org = (self.textx, self.texty)
         fontScale = 1
@@ -70,6 +168,88 @@ class Display:
         thickness = 1
         image = cv2.putText(self.__image, text, org, font,
                    fontScale, color, thickness, cv2.LINE_AA) 
+        (w, h), baseline = cv2.getTextSize(text, font, fontScale, thickness)
+        x0 = max(0, self.textx - 2)
+        y0 = max(0, self.texty - h - 2)
+        self.__dirty.append((x0, y0, min(self.__width, self.textx + w + 2), \
+                min(self.__height, self.texty + baseline + 2)))
 
     def __saveImage(self,filename):
+        if self.__video is not None:
+            if self.video_size != (self.__width, self.__height):
+                self.__video.write(cv2.resize(self.__image, self.video_size, interpolation=cv2.INTER_AREA))
+            else:
+                self.__video.write(self.__image)
+            return
         cv2.imwrite(filename+".jpg", self.__image)
+
+    def __openVideo(self, parms):
+        scale               = parms['videoScale']
+        self.video_step     = max(1, parms['videoFrameStep'])
+        self.video_size     = (max(1, int(self.__width * scale)), max(1, int(self.__height * scale)))
+        fourcc              = cv2.VideoWriter_fourcc(*parms['videoFourcc'])
+        print("Writing video: "+parms['videoFilename'])
+        self.__video        = cv2.VideoWriter(parms['videoFilename'], fourcc, parms['videoFps'], self.video_size)
+        if not self.__video.isOpened():
+            self.__video    = None
+            raise Exception("Can not open video file "+parms['videoFilename'])
+
+    # Finish the video file
+    def close(self):
+        if self.__video is not None:
+            self.__video.release()
+            self.__video = None
+
+#==============================================================================
+#
+# RenderQueue - draw frames on a background thread
+#
+# The filter loop hands a snapshot to submit() and continues, a writer thread
+# draws and saves the frames in order. The queue holds renderQueueSize frames.
+#
+#   renderPolicy    'drop'  - if the queue is full the frame is dropped
+#                   'block' - if the queue is full submit() waits
+#   renderFrameSkip only every Nth submitted frame is queued
+#
+#==============================================================================
+class RenderQueue:
+
+    def __init__(self, parms):
+        self.policy         = parms['renderPolicy']
+        self.frame_skip     = max(1, parms['renderFrameSkip'])
+        self.frames         = queue.Queue(maxsize=max(1, parms['renderQueueSize']))
+        self.submitted      = 0
+        self.dropped        = 0
+        self.thread         = threading.Thread(target=self.__writer, daemon=True)
+        self.thread.start()
+
+    # Queue a frame for display (a Display object)
+    # Returns False if the frame was skipped or dropped
+    def submit(self, display, snap):
+        self.submitted += 1
+        if (self.submitted - 1) % self.frame_skip: return False
+        if self.policy == 'block':
+            with Instrumentation.span('renderWait'):
+                self.frames.put((display, snap))
+            return True
+        try:
+            self.frames.put_nowait((display, snap))
+        except queue.Full:
+            self.dropped += 1
+            Instrumentation.count('framesDropped')
+            return False
+        return True
+
+    def __writer(self):
+        while True:
+            item = self.frames.get()
+            if item is None: break
+            display, snap = item
+            display.draw(snap)
+
+    # Write the queued frames and stop the writer thread
+    def close(self):
+        self.frames.put(None)
+        self.thread.join()
+        if self.dropped:
+            print("Render queue dropped %d of %d frames" % (self.dropped, self.submitted))
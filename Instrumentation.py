@@ -0,0 +1,199 @@
+# Experiments in robot localization using particle filters (algorithm and simulator)
+# Copyright (C) <2021>  Eric Gregori
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import json
+import time
+import threading
+import numpy as np
+
+#==============================================================================
+#
+# Instrumentation - spans and counters for the hot paths (-T traceFilename)
+#
+#   with Instrumentation.span('move') as span:
+#       ...
+#   span.elapsed                        seconds, also when not recording
+#   Instrumentation.count('rayCasts', n)
+#
+# Spans and counters are recorded only after start() with a traceFilename,
+# otherwise a span is two perf_counter calls and count() is one test.
+#
+# The simulator brackets every iteration (filter, logging and display) with
+# startIteration() and endIteration(). The span seconds and counts of each
+# iteration are one sample of the per iteration histograms. A step without
+# data from the robot is not ended, so it is not a sample. stop() writes:
+#
+#   traceFilename                       Chrome trace events (chrome://tracing,
+#                                       Perfetto), one X event per span and the
+#                                       counters of every iteration
+#   traceFilename.histograms.json       per span/counter: mean, percentiles
+#                                       and a histogram over the iterations
+#
+#==============================================================================
+recorder        = None
+HISTOGRAM_BINS  = 10
+
+class Span:
+    __slots__ = ('name', 'start', 'elapsed')
+
+    def __init__(self, name):
+        self.name       = name
+        self.elapsed    = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.elapsed = time.perf_counter() - self.start
+        if recorder is not None:
+            recorder.span(self.name, self.start, self.elapsed)
+        return False
+
+def span(name):
+    return Span(name)
+
+def count(name, n=1):
+    if recorder is not None:
+        recorder.count(name, n)
+
+def startIteration():
+    if recorder is not None:
+        recorder.startIteration()
+
+def endIteration():
+    if recorder is not None:
+        recorder.endIteration()
+
+def start(parms):
+    global recorder
+    if parms.get('traceFilename'):
+        print("Tracing to: "+parms['traceFilename'])
+        recorder = Recorder(parms['traceFilename'])
+
+def stop():
+    global recorder
+    if recorder is not None:
+        recorder.write()
+        recorder = None
+
+#==============================================================================
+#
+# Counter - counts only, the recorder of a worker process. The worker
+# returns the counts of a task and the parent adds them with count().
+#
+#==============================================================================
+class Counter:
+    def __init__(self):
+        self.counts         = dict()
+
+    def span(self, name, start, elapsed):
+        pass
+
+    def count(self, name, n):
+        self.counts[name] = self.counts.get(name, 0) + int(n)
+
+    def startIteration(self):
+        pass
+
+    def endIteration(self):
+        pass
+
+    # Returns the counts since the last take()
+    def take(self):
+        counts, self.counts = self.counts, dict()
+        return counts
+
+#==============================================================================
+#
+# Recorder
+#
+#==============================================================================
+class Recorder:
+    def __init__(self, filename):
+        self.filename       = filename
+        self.lock           = threading.Lock()
+        self.origin         = time.perf_counter()
+        self.events         = []            # (name, start, elapsed, thread)
+        self.counter_events = []            # (start, counts) per iteration
+        self.iterations     = []            # {name: seconds or count} per iteration
+        self.current        = dict()
+        self.threads        = dict()
+
+    def span(self, name, start, elapsed):
+        with self.lock:
+            self.events.append((name, start, elapsed, self.__thread()))
+            self.current[name] = self.current.get(name, 0.0) + elapsed
+
+    def count(self, name, n):
+        with self.lock:
+            self.current[name] = self.current.get(name, 0) + int(n)
+
+    def startIteration(self):
+        with self.lock:
+            self.current = dict()
+
+    def endIteration(self):
+        with self.lock:
+            self.iterations.append(self.current)
+            counts = {k: v for k, v in self.current.items() if isinstance(v, int)}
+            if counts:
+                self.counter_events.append((time.perf_counter(), counts))
+            self.current = dict()
+
+    # Small thread numbers for the trace
+    def __thread(self):
+        ident = threading.get_ident()
+        if ident not in self.threads:
+            self.threads[ident] = len(self.threads)
+        return self.threads[ident]
+
+    def __us(self, t):
+        return (t - self.origin) * 1e6
+
+    def histograms(self):
+        names = sorted({name for iteration in self.iterations for name in iteration})
+        result = dict()
+        for name in names:
+            values = np.array([iteration.get(name, 0) for iteration in self.iterations], dtype=float)
+            counts, edges = np.histogram(values, bins=HISTOGRAM_BINS)
+            result[name] = {'unit': 'count' if any(isinstance(i.get(name), int) for i in self.iterations) \
+                                    else 'seconds',
+                            'iterations': len(values),
+                            'total': float(values.sum()),
+                            'mean': float(values.mean()),
+                            'p50': float(np.percentile(values, 50)),
+                            'p90': float(np.percentile(values, 90)),
+                            'p99': float(np.percentile(values, 99)),
+                            'max': float(values.max()),
+                            'histogram': {'edges': edges.tolist(), 'counts': counts.tolist()}}
+        return result
+
+    def write(self):
+        pid = os.getpid()
+        trace = [{'name': name, 'ph': 'X', 'ts': self.__us(start), 'dur': elapsed * 1e6,
+                  'pid': pid, 'tid': thread} for (name, start, elapsed, thread) in self.events]
+        trace += [{'name': 'counters', 'ph': 'C', 'ts': self.__us(start), 'pid': pid, 'tid': 0,
+                   'args': counts} for (start, counts) in self.counter_events]
+        with open(self.filename, "w") as fp:
+            json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'}, fp)
+        histograms = self.histograms()
+        with open(self.filename + ".histograms.json", "w") as fp:
+            json.dump(histograms, fp, indent=1)
+        print("%-24s %10s %12s %12s %12s" % ("per iteration", "unit", "mean", "p90", "max"))
+        for name, h in histograms.items():
+            print("%-24s %10s %12.6g %12.6g %12.6g" % (name, h['unit'], h['mean'], h['p90'], h['max']))
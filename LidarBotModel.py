@@ -15,12 +15,12 @@
 #    along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import math
-import random
 import numpy as np
+import Instrumentation
 
 #==============================================================================
 #
-# Particle - LidarBot model
+# ParticleSet - LidarBot model for a set of particles
 #
 #            Lidarbot is a differential drive robot with a 360 degree lidar.
 #            The robots static charactericts are: X, Y, heading
@@ -29,81 +29,394 @@ import numpy as np
 #            The lidar sensor provides a vector of 720 distances from the robot center.
 #            The magnetometer sensor provides a heading.
 #
-#            robot_object should point to the robot object.
-#            robot_object should be None if the particle is a robot.
+#            The particles are stored as contiguous arrays (structure of arrays):
+#            x, y, heading, weight, valid and an N x lidarSamples samples matrix.
+#            Move and weight run on all particles at once.
+#
+#            rng is the numpy random Generator used for motion noise. If None, a
+#            Generator is created from parms['randomSeed'].
+#
+#            With headingSource 'search' (magnetometer failure) robotHeading is
+#            not used. Every weigh scans the particles from heading 0 and takes
+#            each particle's heading from the best circular shift against the
+#            robot scan (headingSearch), a particle moves on its own heading.
+#            The robot turns when its scan is blocked ahead, the heading is
+#            then searched again before the move.
 #
 #==============================================================================
-class Particle:
-        def __init__(self, parms, myid = 0):
-            # Init static aspects of the particle
+class ParticleSet:
+        def __init__(self, parms, count = 0, rng = None):
+            # Init static aspects of the particles
             self.parms              = parms
-            self.id                 = myid                           # Particle ID for debugging
             self.lidar_max_dist     = parms['lidarMaxDistance']
             self.lidar_samples      = parms['lidarSamples']
             self.arena              = parms['arena']
+            self.sensor_model       = parms['sensorModel']
+            self.weight_model       = parms['weightModel']
+            self.heading_search     = parms['headingSource'] == 'search'
+            self.heading_window     = parms['headingSearchWindow']
+            self.robot_blocked      = True      # The robot may turn before the next move
+            self.rng                = rng if rng is not None else np.random.default_rng(parms['randomSeed'])
 
             # Noise
             self.measNoise          = parms['measurementSigmaNoise'] # Measurement noise - sigma
-            self.headingNoise       = parms['headingSigmaNoise']     # Heading noise - sigma  
-            self.distanceNoise      = parms['distanceSigmaNoise']    # Distance noise - sigma 
-            self.text               = "P"+str(myid)
+            self.headingNoise       = parms['headingSigmaNoise']     # Heading noise - sigma
+            self.distanceNoise      = parms['distanceSigmaNoise']    # Distance noise - sigma
+            self.likelihoodNoise    = parms['likelihoodSigmaNoise']  # Likelihood field noise - sigma
 
-        # After placement, the weight is valid
-        def place(self, x, y):
-            self.x                  = int(x)                         # Initial position
-            self.y                  = int(y)
-            self.weight             = 0.0                            # Initial weight
-            self.samples            = [0] * self.lidar_samples       # List of samples representing distances
-            self.robot_samples      = self.parms['robotLidarData'] 
-            self.robot_valid_lidar  = self.parms['robotValidLidar']
-            self.__setWeight()                                       # Update particle weights
-            return self.weight
+            self.__next_id          = 0
+            self.__allocate(count)
+
+        def __allocate(self, count):
+            self.x                  = np.zeros(count, dtype=np.intp)
+            self.y                  = np.zeros(count, dtype=np.intp)
+            self.heading            = np.zeros(count)
+            self.weight             = np.zeros(count)
+            self.valid              = np.zeros(count, dtype=bool)
+            self.samples            = np.zeros((count, self.lidar_samples), dtype=np.intp)
+            self.ids                = np.arange(self.__next_id, self.__next_id + count)
+            self.__next_id         += count
+
+        def __len__(self):
+            return len(self.x)
+
+        # Particle views, for code that works on one particle at a time
+        def __getitem__(self, index):
+            if index < 0: index += len(self)
+            if index < 0 or index >= len(self): raise IndexError(index)
+            return Particle(self.parms, pset=self, index=index)
+
+        def __iter__(self):
+            for i in range(len(self)):
+                yield Particle(self.parms, pset=self, index=i)
 
-        # Move particle
+        # Add particles at xs, ys and weigh them. Returns the new indices.
+        def add(self, xs, ys, weigh = True):
+            xs                      = np.asarray(xs, dtype=np.intp).reshape(-1)
+            ys                      = np.asarray(ys, dtype=np.intp).reshape(-1)
+            n                       = len(xs)
+            start                   = len(self)
+            self.x                  = np.concatenate((self.x, xs))
+            self.y                  = np.concatenate((self.y, ys))
+            self.heading            = np.concatenate((self.heading, np.full(n, float(self.parms['robotHeading']))))
+            self.weight             = np.concatenate((self.weight, np.zeros(n)))
+            self.valid              = np.concatenate((self.valid, np.zeros(n, dtype=bool)))
+            self.samples            = np.concatenate((self.samples,
+                                        np.zeros((n, self.lidar_samples), dtype=np.intp)))
+            self.ids                = np.concatenate((self.ids, np.arange(self.__next_id, self.__next_id + n)))
+            self.__next_id         += n
+            index                   = np.arange(start, start + n)
+            if weigh:
+                self.weigh(index)
+            return index
+
+        # Append the particles of other selected by mask (all if None)
+        def extend(self, other, mask = None):
+            if mask is None: mask = slice(None)
+            n                       = len(other.x[mask])
+            self.x                  = np.concatenate((self.x, other.x[mask]))
+            self.y                  = np.concatenate((self.y, other.y[mask]))
+            self.heading            = np.concatenate((self.heading, other.heading[mask]))
+            self.weight             = np.concatenate((self.weight, other.weight[mask]))
+            self.valid              = np.concatenate((self.valid, other.valid[mask]))
+            self.samples            = np.concatenate((self.samples, other.samples[mask]))
+            self.ids                = np.concatenate((self.ids, np.arange(self.__next_id, self.__next_id + n)))
+            self.__next_id         += n
+
+        # Keep the particles selected by mask (or index array), drop the rest
+        def keep(self, mask):
+            self.x                  = self.x[mask]
+            self.y                  = self.y[mask]
+            self.heading            = self.heading[mask]
+            self.weight             = self.weight[mask]
+            self.valid              = self.valid[mask]
+            self.samples            = self.samples[mask]
+            self.ids                = self.ids[mask]
+
+        #==============================================================================
+        #
+        # Low variance (systematic) resampling
+        #
+        # Draws count particles with probability proportional to weight using one
+        # random offset, O(N + count). Copies keep the weight, samples and ID of
+        # their parent. Each copy is then jittered by a Gaussian of sigma jitter
+        # pixels, a jittered position that is in a wall or outside the arena is
+        # not used. No sensor evaluation is done, the next move() weighs them.
+        #
+        # Returns False (and does nothing) if all weights are 0.
+        #
+        #==============================================================================
+        def resample(self, count, jitter = 0.0):
+            total                   = self.weight.sum()
+            if count <= 0 or len(self) == 0 or total <= 0: return False
+            positions               = (self.rng.random() + np.arange(count)) / count
+            index                   = np.searchsorted(np.cumsum(self.weight) / total, positions, side='right')
+            self.keep(np.minimum(index, len(self) - 1))
+            if jitter > 0:
+                x                   = self.x + np.round(self.rng.normal(0, jitter, count)).astype(np.intp)
+                y                   = self.y + np.round(self.rng.normal(0, jitter, count)).astype(np.intp)
+                free                = (x >= 0) & (y >= 0) & ~self.arena.checkXYBatch(x, y)
+                self.x              = np.where(free, x, self.x)
+                self.y              = np.where(free, y, self.y)
+            return True
+
+        # Place the particles at index at xs, ys. After placement, the weight is valid.
+        def place(self, index, xs, ys):
+            self.x[index]           = xs
+            self.y[index]           = ys
+            self.heading[index]     = self.parms['robotHeading']
+            self.weight[index]      = 0.0                            # Initial weight
+            self.weigh(index)
+            return self.weight[index]
+
+        # Move all particles
         # Scan Lidar
-        # For particles, update weights
+        # Update weights
         # After moving, the weight is valid
+        # Returns a vector, True where the particle collided
+        #
+        # Each particle takes round(N(robotDistance, distanceNoise)) one pixel
+        # steps, each on a heading drawn from N(robotHeading, headingNoise).
+        # Before each step the pixel one ahead on the heading beam is probed,
+        # the particle stops at the first probe that hits a wall. All the
+        # noise is drawn at once and all probes are one lookup.
         def move(self):
-            collision = False
-            for i in range(round(random.gauss(self.parms['robotDistance'], self.distanceNoise))):
-                self.valid_lidar = self.arena.readLidar(self.x, self.y, 
-                        self.samples, max_dist=3) # Update Lidar after placement
-                if self.samples[0] <= 1:
-                    collision = True
-                    break
-                # no collision
-                heading = random.gauss(self.parms['robotHeading'], self.headingNoise)
-                self.x += math.cos(heading)
-                self.y += math.sin(heading)
-            self.x = int(self.x)
-            self.y = int(self.y)
-            self.__setWeight()
+            n                       = len(self)
+            if not self.heading_search:
+                self.heading[:]     = self.parms['robotHeading']
+            elif self.robot_blocked and self.parms['robotValidLidar']:
+                # The robot was blocked and turned, the new scan from where
+                # the particle is gives the heading it moved on
+                self.weigh()
+            heading                 = self.heading.astype(np.float32)
+            steps                   = np.round(self.rng.normal(self.parms['robotDistance'],
+                                        self.distanceNoise, n)).astype(np.intp)
+            collision               = np.zeros(n, dtype=bool)
+            x                       = np.empty(n)
+            y                       = np.empty(n)
+            # Collision probe, one pixel ahead on the heading beam
+            s                       = np.trunc(self.heading/((2 * math.pi)/self.lidar_samples)).astype(np.intp)
+            s                      %= self.lidar_samples
+            xa                      = self.arena.scan_dx[s,1]
+            ya                      = self.arena.scan_dy[s,1]
+            k                       = max(0, int(steps.max(initial=0)))
+            # A particle with more clearance than the path and the probe can reach
+            # can not collide, only the other particles are probed
+            inside                  = (self.x >= 0) & (self.x < self.arena.width) & \
+                                      (self.y >= 0) & (self.y < self.arena.height)
+            clearance               = self.arena.clearance[np.where(inside, self.y, 0), np.where(inside, self.x, 0)]
+            probe                   = ~inside | (clearance <= steps + 3)
+            block                   = max(1, 1000000 // max(k, 1))
+            for b in range(0, n, block):
+                e                   = min(n, b + block)
+                # A heading for every step, single precision is plenty for the noise
+                h                   = self.rng.standard_normal((e - b, k), dtype=np.float32)
+                h                  *= np.float32(self.headingNoise)
+                h                  += heading[b:e,None]
+                dx                  = np.cos(h)
+                dy                  = np.sin(h)
+                # Steps past the particle's step count do not move it
+                taken               = np.arange(k) < steps[b:e,None]
+                dx                 *= taken
+                dy                 *= taken
+                x[b:e]              = self.x[b:e] + dx.sum(axis=1, dtype=np.float64)
+                y[b:e]              = self.y[b:e] + dy.sum(axis=1, dtype=np.float64)
+                p                   = np.nonzero(probe[b:e])[0]
+                if len(p) == 0 or k == 0: continue
+                # Swept check, the position before each step and the probes along
+                # the whole path in one lookup
+                path_x              = np.empty((len(p), k + 1))
+                path_y              = np.empty((len(p), k + 1))
+                path_x[:,0]         = self.x[b+p]
+                path_y[:,0]         = self.y[b+p]
+                np.cumsum(dx[p], axis=1, dtype=np.float64, out=path_x[:,1:])
+                np.cumsum(dy[p], axis=1, dtype=np.float64, out=path_y[:,1:])
+                path_x[:,1:]       += path_x[:,:1]
+                path_y[:,1:]       += path_y[:,:1]
+                hit                 = self.arena.checkXYBatch(path_x[:,:k] + xa[b+p,None],
+                                                              path_y[:,:k] + ya[b+p,None])
+                hit                &= taken[p]
+                Instrumentation.count('motionProbes', hit.size)
+                hits                = hit.any(axis=1)
+                collision[b+p]      = hits
+                # Stop before the first step that hits
+                stop                = np.where(hits, hit.argmax(axis=1), np.clip(steps[b+p], 0, k))
+                x[b+p]              = path_x[np.arange(len(p)), stop]
+                y[b+p]              = path_y[np.arange(len(p)), stop]
+            self.x                  = x.astype(np.intp)
+            self.y                  = y.astype(np.intp)
+            # The robot turns when its scan is blocked ahead
+            self.robot_blocked      = self.parms['robotLidarData'][0] <= 1
+            self.weigh(heading_window=self.heading_window)
             return collision
 
-        # Calculate a weight by comparing this particles lidar data with the robot's lidar data
+        # Calculate weights by comparing the particles lidar data with the robot's lidar data
         # If the robot is in a deadzone, the calculated weight is invalid.
-        # It is important that the place() function does not try to place a particle
+        # It is important that place() is not used to place a particle
         # in an invalid location.
-        def __setWeight(self):
-            self.valid_lidar = self.arena.readLidar(self.x, self.y, self.samples) # Update Lidar after placement
+        # heading_window (headingSource 'search') - only search the headings
+        # within heading_window beams of the particle's heading
+        def weigh(self, index = None, heading_window = None):
+            with Instrumentation.span('weigh'):
+                self.__weigh(index, heading_window)
+
+        def __weigh(self, index, heading_window):
+            if index is None: index = slice(None)
+            xs                      = self.x[index]
+            ys                      = self.y[index]
+            if len(xs) == 0: return
+            Instrumentation.count('weighedParticles', len(xs))
+            robot_samples           = self.parms['robotLidarData']
+            if self.sensor_model == 'likelihood':
+                weights = self.arena.scoreLikelihood(xs, ys, robot_samples, self.heading[index],
+                                                     self.likelihoodNoise)
+                # If the robot sensor data is not valid do not change the weight
+                if self.parms['robotValidLidar']:
+                    self.weight[index] = weights
+                return
+            if self.heading_search:
+                return self.__weighSearch(index, xs, ys, robot_samples, heading_window)
+            samples, valid          = self.arena.readLidarMemo(xs, ys, self.heading[index])
+            self.samples[index]     = samples
+            self.valid[index]       = valid
             # If the robot sensor data is not valid do not change the weight
+            if not self.parms['robotValidLidar']: return
+            if self.weight_model == 'gaussian':
+                weights = gaussianWeights(robot_samples, samples, self.measNoise)
+            else:
+                weights = correlationWeights(robot_samples, samples)
+                # Weight is not changed where the correlation is undefined
+                weights = np.where(np.isnan(weights), self.weight[index], np.maximum(weights, 0))
+            self.weight[index]      = np.where(valid, weights, 0.0)
+
+        # headingSource 'search': the heading of each particle is the circular
+        # shift of its scan from heading 0 that best matches the robot scan,
+        # at the middle of the beam. Samples are stored from that heading.
+        # After a move only the shifts within heading_window beams of the
+        # heading the particle moved on are searched.
+        # Without a valid robot scan the heading and weight are not changed.
+        def __weighSearch(self, index, xs, ys, robot_samples, heading_window):
+            samples, valid          = self.arena.readLidarMemo(xs, ys, 0.0)
+            shift                   = np.trunc(self.heading[index]/((2 * math.pi)/self.lidar_samples))
+            shift                   = shift.astype(np.intp) % self.lidar_samples
             if self.parms['robotValidLidar']:
-                if self.valid_lidar == False:
-                    self.weight = 0.0
-                    return 0.0
-                result = np.corrcoef(np.array(self.robot_samples), np.array(self.samples))
-                if result[0][1] == result[1][0]:
-                    if result[0][1] > 0:
-                        self.weight = result[0][1]
-                    else:
-                        self.weight = 0
-                    return self.weight
-#                   px = self.Gaussian(meas[0], self.meas_noise, self.x)
-#                   py = self.Gaussian(meas[1], self.meas_noise, self.y)
-
-        # Gaussian - from robot class
-        def __gaussian(self,mu, sigma, x):
-                # calculates the probability of x for 1-dim Gaussian with mean mu and var. sigma
-                return exp(- ((mu - x) ** 2) / (sigma ** 2) / 2.0) / sqrt(2.0 * math.pi * (sigma ** 2))
+                around              = shift if heading_window is not None else None
+                shift, score        = headingSearch(robot_samples, samples, around, heading_window)
+                self.heading[index] = (shift + 0.5) * ((2 * math.pi)/self.lidar_samples)
+            beams                   = (np.arange(self.lidar_samples) + shift[:,None]) % self.lidar_samples
+            samples                 = np.take_along_axis(samples, beams, axis=1)
+            self.samples[index]     = samples
+            self.valid[index]       = valid
+            if not self.parms['robotValidLidar']: return
+            if self.weight_model == 'gaussian':
+                weights = gaussianWeights(robot_samples, samples, self.measNoise)
+            else:
+                weights = np.where(np.isnan(score), self.weight[index], np.maximum(score, 0))
+            self.weight[index]      = np.where(valid, weights, 0.0)
+
+#==============================================================================
+#
+# Batched weights
+#
+#   robot_samples - the robot's lidar scan, lidarSamples distances
+#   samples       - N x lidarSamples matrix of particle scans
+#
+# Both return an N vector of weights, one per row of samples.
+#
+#==============================================================================
+
+# Pearson correlation between the robot scan and every particle scan,
+# same as np.corrcoef(robot_samples, samples[i])[0][1] for each i.
+# nan where a scan is constant.
+def correlationWeights(robot_samples, samples):
+    a = np.asarray(robot_samples, dtype=float)
+    b = np.asarray(samples, dtype=float)
+    a = a - a.mean()
+    b = b - b.mean(axis=1, keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        r = (b @ a) / (np.sqrt((b * b).sum(axis=1)) * np.sqrt((a * a).sum()))
+    return np.clip(r, -1, 1)
+
+# Heading search - the circular shift of each particle scan that best matches
+# the robot scan, all lidarSamples shifts at once by FFT cross correlation.
+# samples are scans from heading 0. Returns (shift, score): the robot scan
+# matches samples[i] rotated to start at beam shift[i], score[i] is the
+# correlationWeights of that rotated scan, nan where a scan is constant.
+# With around (N start beams) only the shifts within window beams of
+# around[i] are searched.
+def headingSearch(robot_samples, samples, around = None, window = 0):
+    a = np.asarray(robot_samples, dtype=float)
+    b = np.asarray(samples, dtype=float)
+    n = a.shape[-1]
+    a = a - a.mean()
+    b = b - b.mean(axis=1, keepdims=True)
+    # c[i, s] = sum_j a[j] * b[i, (j + s) % n]
+    c = np.fft.irfft(np.conj(np.fft.rfft(a))[None,:] * np.fft.rfft(b, axis=1), n, axis=1)
+    if around is not None:
+        d = (np.arange(n)[None,:] - np.asarray(around)[:,None]) % n
+        c[np.minimum(d, n - d) > window] = -np.inf
+    shift = c.argmax(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        r = c[np.arange(len(b)), shift] / (np.sqrt((b * b).sum(axis=1)) * np.sqrt((a * a).sum()))
+    return shift, np.clip(r, -1, 1)
+
+# Gaussian beam likelihood with measurement noise sigma. Each beam is scored
+# with a gaussian normalized to 1 at zero error, the weight is the geometric
+# mean over the beams so it stays in [0,1] for any lidarSamples.
+# A beam is 2pi/lidarSamples wide, a small position error moves the wall it
+# hits by up to half the beam width times the distance. The sigma of a beam
+# is sigma plus that, so far beams are not scored much harder than the map
+# resolution allows.
+def gaussianWeights(robot_samples, samples, sigma):
+    a = np.asarray(robot_samples, dtype=float)
+    b = np.asarray(samples, dtype=float)
+    sigma = sigma + a * (math.pi / a.shape[-1])
+    # Log of the normalized gaussian, the mean does not underflow
+    log_p = -((a - b) ** 2) / (2.0 * sigma ** 2)
+    return np.exp(log_p.mean(axis=1))
+
+#==============================================================================
+#
+# Particle - view of one particle in a ParticleSet
+#
+#            Used by Display and DataLogger. A Particle created without a
+#            ParticleSet owns a set of one particle.
+#
+#==============================================================================
+class Particle:
+        def __init__(self, parms, myid = 0, pset = None, index = 0):
+            if pset is None:
+                pset                = ParticleSet(parms, 1)
+                pset.ids[0]         = myid
+            self.parms              = parms
+            self.pset               = pset
+            self.index              = index
 
+        @property
+        def id(self): return int(self.pset.ids[self.index])         # Particle ID for debugging
+        @property
+        def text(self): return "P"+str(self.id)
+        @property
+        def x(self): return int(self.pset.x[self.index])
+        @property
+        def y(self): return int(self.pset.y[self.index])
+        @property
+        def heading(self): return float(self.pset.heading[self.index])
+        @property
+        def weight(self): return float(self.pset.weight[self.index])
+        @property
+        def samples(self): return self.pset.samples[self.index]
+        @property
+        def valid_lidar(self): return bool(self.pset.valid[self.index])
 
+        # After placement, the weight is valid
+        def place(self, x, y):
+            self.pset.place([self.index], [int(x)], [int(y)])
+            return self.weight
+
+        # Move a particle that has its own set. A view into a larger set can
+        # not move alone, the whole set is moved with ParticleSet.move().
+        def move(self):
+            if len(self.pset) != 1:
+                raise Exception("Particle.move would move every particle in its set, use ParticleSet.move")
+            return bool(self.pset.move()[self.index])
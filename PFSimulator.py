@@ -16,14 +16,12 @@
 
 import getopt
 import sys
-import os
-import time                         # Used for performance measuring
 import Arena
 import Display
 import DataLogger
-import TrackingFilter
+import Session
+import Instrumentation
 import Configuration as Config
-import RobotServer as rs
 
 #==============================================================================
 #
@@ -33,12 +31,18 @@ import RobotServer as rs
 def usage():
     print("!ERROR! Illegal parameter")
     print("Required: -a arenaFilename -i iterations ")
-    print("Optional strings:  [-o outputPath] [-d dataFilename] [-m plot samples] [-s server IP]")
+    print("Optional strings:  [-o outputPath] [-d dataFilename] [-s server IP]")
+    print("                   [-e video filename, graphics output to a video file]")
+    print("                   [-R record filename] [-P replay filename, instead of the robot]")
+    print("                   [-T trace filename, Chrome trace JSON and per iteration histograms]")
     print("Optional ints: [-x -y -h Initial robot position] [-w Initial weight threshold] [-p numberOfParticles]")
-    print("Optional Flags: [-v verbose] [-g output graphics]")
+    print("               [-j worker processes] [-r random seed] [-n number of robots]")
+    print("Optional Flags: [-v verbose] [-g output graphics] [-m plot samples] [-l log particles with -d]")
+    print("                [-G coarse to fine global localization] [-M no magnetometer, heading search]")
+    print("                [-S scan matching] [-t tracking mode]")
     print("-o must be specified with -d")
     print("-o must be specified with -m")
-    print("-o must be specified with -g")
+    print("-o must be specified with -g, unless -e is used")
     sys.exit(-1)
 
 #==============================================================================
@@ -50,14 +54,24 @@ def main(argv):
     parameters = dict()
     config = Config.Configuration(parameters)
     try:
-        opts, args = getopt.getopt(argv, "vgi:o:a:d:p:m:x:y:h:w:s:")
+        opts, args = getopt.getopt(argv, "vglmGMSti:o:a:d:p:x:y:h:w:s:j:r:n:e:R:P:T:")
     except getopt.GetoptError:
         usage()
     for opt, arg in opts:
         if opt in ("-v"):  # -v verbose
             parameters['verbose']           = True
+        elif opt in ("-l"):
+            parameters['logParticles']      = True
         elif opt in ("-m"):
             parameters['plotSamples']       = True
+        elif opt in ("-G"):
+            parameters['globalLocalization']= 'pyramid'     # Coarse to fine global localization
+        elif opt in ("-M"):
+            parameters['headingSource']     = 'search'      # No magnetometer, headings from the scans
+        elif opt in ("-S"):
+            parameters['scanMatching']      = True          # Refine the prediction by scan matching
+        elif opt in ("-t"):
+            parameters['trackingMode']      = True          # Local work once converged
         elif opt in ("-g"):
             parameters['plotGraphics']      = True
         elif opt in ("-o"):
@@ -80,13 +94,31 @@ def main(argv):
             parameters['robotH']            = float(arg)
         elif opt in ("-w"):
             parameters['initialWeightThres']= float(arg)
+        elif opt in ("-j"):
+            parameters['workers']           = int(arg)
+        elif opt in ("-r"):
+            parameters['randomSeed']        = int(arg)
+        elif opt in ("-n"):
+            parameters['robots']            = int(arg)
+        elif opt in ("-e"):
+            parameters['plotGraphics']      = True
+            parameters['displayOutput']     = 'video'
+            parameters['videoFilename']     = arg
+        elif opt in ("-R"):
+            parameters['recordFilename']    = arg           # Record the robot messages
+        elif opt in ("-T"):
+            parameters['traceFilename']     = arg           # Spans and counters, Chrome trace JSON
+        elif opt in ("-P"):
+            parameters['replayFilename']    = arg           # Replay recorded robot messages
 
     if config.verify(parameters):
         usage()
 
+    Instrumentation.start(parameters)
     print("Initializing arena")
     try:
-        parameters['arena'] = Arena.Arena(parameters)
+        with Instrumentation.span('arenaInit'):
+            parameters['arena'] = Arena.Arena(parameters)
     except Exception as e:
         print("Failure loading arena: "+str(e))
         usage()
@@ -96,26 +128,56 @@ def main(argv):
         print("Initializing datalogger")
         datalogger_object.startDataLogger(parameters)
 
-    prediction = (0,0,0)
-    robot_server = rs.RobotServer(parameters)
-    if robot_server.start(parameters) < 0:
+    sessions = Session.SessionManager(parameters)
+    if sessions.start() < 0:
         print("Failure starting the server")
+        sessions.close()
         sys.exit(-2)
-    for iteration in range(parameters['iterations']):
-        start_time = time.perf_counter()
-        dtext = [("Iteration %d"%iteration,False)] # Only output to console
-        state = robot_server.getDataFromRobot(parameters, dtext)
-        prediction = TrackingFilter.particleFilter(parameters, state, dtext)
-        elapsed_time = time.perf_counter() - start_time
-        dtext.append(("TT:%f"%elapsed_time,False))
-        for field in dtext:
-            print(field[0], end=" ")
-        print()
-        if parameters['plotGraphics']:
-            filename = parameters['outputPath']+"/iteration" + str(iteration)
-            Display.Display(parameters, filename, dtext, prediction)
-        if parameters['plotSamples']:
-            self.datalogger_object.plotSamples(parameters, parameters['outputPath']+"/lidar" + str(iteration))
+    displays = dict()
+    renderer = None
+    if parameters['plotGraphics'] and parameters['renderMode'] == 'background':
+        renderer = Display.RenderQueue(parameters)
+    try:
+        while not sessions.done():
+            Instrumentation.startIteration()
+            session, iteration, dtext = sessions.step()
+            if iteration is None and len(sessions.sessions) > 1: continue
+            for field in dtext:
+                print(field[0], end=" ")
+            print()
+            if iteration is None: continue
+            with Instrumentation.span('log'):
+                datalogger_object.logIteration(session.parms, session.robot_id, iteration, \
+                                               session.state, session.elapsed_time)
+            output = parameters.get('outputPath', "")
+            if len(sessions.sessions) > 1:
+                output += "/robot%d_"%session.robot_id
+            else:
+                output += "/"
+            if parameters['plotGraphics']:
+                filename = output + "iteration" + str(iteration)
+                if session.robot_id not in displays:
+                    if parameters['displayOutput'] == 'video':
+                        session.parms['videoFilename'] = Session.robotFilename(parameters, \
+                                                            parameters['videoFilename'], session.robot_id)
+                    displays[session.robot_id] = Display.Display(session.parms)
+                snap = Display.snapshot(session.parms, filename, dtext, session.prediction)
+                if renderer is not None:
+                    renderer.submit(displays[session.robot_id], snap)
+                else:
+                    displays[session.robot_id].draw(snap)
+            if parameters['plotSamples']:
+                with Instrumentation.span('plotSamples'):
+                    datalogger_object.plotSamples(session.parms, output + "lidar" + str(iteration))
+            Instrumentation.endIteration()
+    finally:
+        if renderer is not None:
+            renderer.close()
+        for display in displays.values():
+            display.close()
+        sessions.close()
+        datalogger_object.close()
+        Instrumentation.stop()
 
 if __name__ == '__main__':
     sys.exit(main(sys.argv[1:]))
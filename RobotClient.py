@@ -0,0 +1,100 @@
+# Experiments in robot localization using particle filters (algorithm and simulator)
+# Copyright (C) <2021>  Eric Gregori
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import getopt
+import socket
+import sys
+import time
+import Arena
+import Configuration as Config
+import RobotServer as rs
+
+#==============================================================================
+#
+# RobotClient - stand-in robot for testing the robot server
+#
+# Runs the simulated robot from RobotServer and sends its data to a server
+# started with PFSimulator.py -s serverIP, using the robot protocol framing.
+# The simulated robot position is sent as ground truth.
+#
+#==============================================================================
+
+#==============================================================================
+#
+# usage
+#
+#==============================================================================
+def usage():
+    print("!ERROR! Illegal parameter")
+    print("Required: -a arenaFilename -i iterations -s server IP")
+    print("Optional ints: [-x -y -h Initial robot position] [-t seconds between messages] [-p server port]")
+    sys.exit(-1)
+
+#==============================================================================
+#
+# main
+#
+#==============================================================================
+def main(argv):
+    parameters = dict()
+    Config.Configuration(parameters)
+    delay = 0.0
+    try:
+        opts, args = getopt.getopt(argv, "a:i:s:x:y:h:t:p:")
+    except getopt.GetoptError:
+        usage()
+    for opt, arg in opts:
+        if opt in ("-a"):
+            parameters['arenaFilename']     = arg
+        elif opt in ("-i"):
+            parameters['iterations']        = int(arg)
+        elif opt in ("-s"):
+            server_ip                       = arg
+        elif opt in ("-x"):
+            parameters['robotX']            = int(arg)
+        elif opt in ("-y"):
+            parameters['robotY']            = int(arg)
+        elif opt in ("-h"):
+            parameters['robotH']            = float(arg)
+        elif opt in ("-t"):
+            delay                           = float(arg)
+        elif opt in ("-p"):
+            parameters['serverPort']        = int(arg)
+    if 'arenaFilename' not in parameters or 'iterations' not in parameters or 'server_ip' not in locals():
+        usage()
+
+    parameters['arena'] = Arena.Arena(parameters)
+    robot = rs.RobotServer(parameters) # No serverIP, simulated robot
+    print("Connecting to server: %s:%d" % (server_ip, parameters['serverPort']))
+    connection = socket.create_connection((server_ip, parameters['serverPort']))
+    no_return = parameters['lidarMaxDistance'] - 1
+    for iteration in range(parameters['iterations']):
+        dtext = []
+        state = robot.getDataFromRobot(parameters, dtext)
+        lidar = [min(d, no_return) for d in parameters['robotLidarData']]
+        truth = parameters['simulatedRobotPath'][-1]
+        if state == 'init':
+            frame = rs.encodeFrame(rs.MSG_INIT, parameters['robotHeading'], 0.0, lidar, truth)
+        else:
+            frame = rs.encodeFrame(rs.MSG_UPDATE, parameters['robotHeading'], \
+                        parameters['robotDistance'] * parameters['distanceToPixel'], lidar, truth)
+        connection.sendall(frame)
+        print("Sent %s %s" % (state, str(truth)))
+        if delay > 0: time.sleep(delay)
+    connection.close()
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
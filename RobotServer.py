@@ -16,15 +16,145 @@
 
 import random
 import math
+import queue
+import struct
+import asyncio
+import threading
+import numpy as np
 import LidarBotModel as model
+import Instrumentation
+
+#==============================================================================
+#
+# Robot protocol - binary framing
+#
+# Every message is one fixed size frame, little endian:
+#
+#   uint8   message type    MSG_INIT or MSG_UPDATE
+#   uint8   flags           reserved, 0
+#   uint16  count           number of lidar samples, must equal lidarSamples
+#   float32 heading         magnetometer heading in radians
+#   float32 distance        distance moved since the last message in robot counts
+#                           (divided by distanceToPixel), 0 for MSG_INIT
+#   float32 truth x, y      ground truth position in pixels, NaN if unknown
+#   uint16  lidar[count]    distances in pixels, starting at the heading.
+#                           lidarMaxDistance-1 or more is no return.
+#
+#==============================================================================
+MSG_INIT        = 1
+MSG_UPDATE      = 2
+FRAME_HEADER    = struct.Struct('<BBHffff')
+
+def frameSize(lidar_samples):
+    return FRAME_HEADER.size + 2 * lidar_samples
+
+def encodeFrame(msg_type, heading, distance, lidar, truth=(math.nan, math.nan)):
+    lidar = np.asarray(lidar, dtype='<u2')
+    return FRAME_HEADER.pack(msg_type, 0, len(lidar), heading, distance, truth[0], truth[1]) + \
+           lidar.tobytes()
+
+#==============================================================================
+#
+# Replay file - recorded robot messages (-R record, -P replay)
+#
+#   char[8] magic           REPLAY_MAGIC
+#   uint16  version         REPLAY_VERSION
+#   uint16  count           number of lidar samples
+#   int64   seed            randomSeed for the filter, -1 if none
+#
+# followed by one robot protocol frame per message, exactly as the robot
+# sent them, so a recording of a real robot replays bit for bit.
+#
+#==============================================================================
+REPLAY_MAGIC    = b'PFREPLAY'
+REPLAY_VERSION  = 1
+REPLAY_HEADER   = struct.Struct('<8sHHq')
+
+#==============================================================================
+#
+# RobotProtocol - receives frames from the robot
+#
+# Runs on the server's asyncio thread. Frames are received directly into one
+# of a ring of frame buffers (no copy). A complete frame is handed to the
+# filter thread through a queue, the filter gives the buffer back when it
+# takes the next frame. If the filter falls behind and no buffer is free,
+# reading from the socket is paused until one is given back.
+#
+#==============================================================================
+class RobotProtocol(asyncio.BufferedProtocol):
+    def __init__(self, server):
+        self.server             = server
+        self.transport          = None
+        self.slot               = None
+
+    def connection_made(self, transport):
+        if self.server.transport is not None:
+            print("!ERROR! Robot already connected, closing new connection")
+            transport.close()
+            return
+        print("Robot connected: "+str(transport.get_extra_info('peername')))
+        self.transport          = transport
+        self.server.protocol    = self
+        self.server.transport   = transport
+        self.nextSlot()
+
+    def connection_lost(self, exc):
+        if self.server.protocol is self:
+            print("Robot disconnected")
+            if self.slot is not None:
+                self.server.free_slots.append(self.slot)
+                self.slot           = None
+            self.server.protocol    = None
+            self.server.transport   = None
+
+    # Start receiving into a free buffer, or pause reading if there is none
+    def nextSlot(self):
+        if self.server.free_slots:
+            self.slot           = self.server.free_slots.pop()
+            self.received       = 0
+            self.transport.resume_reading()
+        else:
+            self.slot           = None
+            self.transport.pause_reading()
+
+    def get_buffer(self, sizehint):
+        return memoryview(self.server.buffers[self.slot])[self.received:]
+
+    def buffer_updated(self, nbytes):
+        start                   = self.received
+        self.received          += nbytes
+        if start < FRAME_HEADER.size <= self.received:
+            msg_type, flags, count = FRAME_HEADER.unpack_from(self.server.buffers[self.slot])[:3]
+            if msg_type not in (MSG_INIT, MSG_UPDATE) or count != self.server.lidar_samples:
+                print("!ERROR! Bad frame from robot (type %d, count %d)" % (msg_type, count))
+                self.transport.close()
+                return
+        if self.received == len(self.server.buffers[self.slot]):
+            self.server.frames.put(self.slot)
+            self.nextSlot()
+
+    # Called on the asyncio thread when the filter is done with a buffer
+    def releaseSlot(self, slot):
+        self.server.free_slots.append(slot)
+        if self.slot is None and self.transport is not None and not self.transport.is_closing():
+            self.nextSlot()
 
 class RobotServer:
     def __init__(self, parms):
         self.arena                   = parms['arena']
         parms['robotLidarData']      = [0] * parms['lidarSamples']  # List of samples representing distances
-        if 'serverIP' in parms:
+        self.record                  = None
+        self.frame                   = None     # Last frame from a real robot or the replay
+        self.finished                = False    # True at the end of a replay
+        self.loop                    = None     # Event loop of the real robot server
+        self.server                  = None
+        if 'replayFilename' in parms:
+            self.get_robot_data      = self.__getDataFromReplay
+            self.robot_on            = False
+        elif 'serverIP' in parms:
             self.get_robot_data      = self.__getDataFromRealRobot
-            print("Connecting to server: "+parms['serverIP'])
+            self.lidar_samples       = parms['lidarSamples']
+            self.timeout             = parms['serverTimeout']
         else:
             print("Using simulated robot")
             self.turn_offset         = parms['robotTurnOffset']
@@ -32,8 +162,128 @@ class RobotServer:
             self.robot_on            = False
 
     def start(self, parameters):
+        status = 0
+        if 'replayFilename' in parameters:
+            status = self.__openReplay(parameters)
+        elif 'serverIP' in parameters:
+            status = self.__startServer(parameters)
+        if status == 0 and 'recordFilename' in parameters:
+            status = self.__startRecording(parameters)
+        return status
+
+    def stop(self):
+        if self.loop is not None:
+            if self.server is not None:
+                asyncio.run_coroutine_threadsafe(self.__closeServer(), self.loop).result()
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+            self.loop.close()
+            self.loop = None
+        if self.record is not None:
+            self.record.close()
+            self.record = None
+
+    #==============================================================================
+    #
+    # Record and replay
+    #
+    # The recording starts with the seed of the filter random generator. If no
+    # seed was given (-r) one is picked, so the replay reproduces the filter
+    # exactly. The replay uses the recorded seed unless -r overrides it.
+    #
+    # The replay file is memory mapped, the lidar samples of each frame are a
+    # numpy view that becomes robotLidarData.
+    #
+    #==============================================================================
+    def __startRecording(self, parms):
+        if parms['randomSeed'] is None:
+            parms['randomSeed']     = int(np.random.SeedSequence().entropy % (2**63))
+        print("Recording: %s (seed %d)" % (parms['recordFilename'], parms['randomSeed']))
+        try:
+            self.record             = open(parms['recordFilename'], "wb")
+        except OSError as e:
+            print("!ERROR! "+str(e))
+            return -1
+        self.record.write(REPLAY_HEADER.pack(REPLAY_MAGIC, REPLAY_VERSION, \
+                            parms['lidarSamples'], parms['randomSeed']))
+        return 0
+
+    def __recordFrame(self, parms, state):
+        if self.frame is None:
+            # Simulated robot
+            msg_type                = MSG_INIT if state == 'init' else MSG_UPDATE
+            distance                = parms['robotDistance'] * parms['distanceToPixel'] if state == 'update' else 0
+            truth                   = parms['simulatedRobotPath'][-1]
+            self.frame              = encodeFrame(msg_type, parms['robotHeading'], distance, \
+                                        parms['robotLidarData'], truth)
+        self.record.write(self.frame)
+        self.frame                  = None
+
+    def __openReplay(self, parms):
+        print("Replaying: "+parms['replayFilename'])
+        try:
+            data                    = np.memmap(parms['replayFilename'], dtype=np.uint8, mode='r')
+            (magic, version, count, seed) = REPLAY_HEADER.unpack_from(data)
+        except (OSError, ValueError, struct.error) as e:
+            print("!ERROR! "+str(e))
+            return -1
+        if magic != REPLAY_MAGIC or version != REPLAY_VERSION:
+            print("!ERROR! Not a replay file: "+parms['replayFilename'])
+            return -1
+        if count != parms['lidarSamples']:
+            print("!ERROR! Replay has %d lidar samples, lidarSamples is %d" % (count, parms['lidarSamples']))
+            return -1
+        if parms['randomSeed'] is None and seed >= 0:
+            parms['randomSeed']     = seed
+        size                        = frameSize(count)
+        frames                      = (len(data) - REPLAY_HEADER.size) // size
+        self.replay_frames          = data[REPLAY_HEADER.size:REPLAY_HEADER.size + frames*size].reshape(frames, size)
+        self.replay_next            = 0
+        print("Replay: %d frames, seed %s" % (frames, str(parms['randomSeed'])))
         return 0
 
+    #==============================================================================
+    #
+    # Server for a real robot
+    #
+    # The asyncio event loop runs on its own thread, so the filter never waits
+    # on a socket. serverSlots frame buffers are allocated once, the lidar
+    # samples of each buffer are a numpy view that becomes robotLidarData.
+    #
+    #==============================================================================
+    def __startServer(self, parms):
+        print("Starting server: %s:%d" % (parms['serverIP'], parms['serverPort']))
+        size                    = frameSize(self.lidar_samples)
+        self.buffers            = [bytearray(size) for i in range(max(2, parms['serverSlots']))]
+        self.lidar_views        = [np.frombuffer(b, dtype='<u2', offset=FRAME_HEADER.size, \
+                                    count=self.lidar_samples) for b in self.buffers]
+        self.free_slots         = list(range(len(self.buffers)))
+        self.frames             = queue.Queue()
+        self.current_slot       = None
+        self.protocol           = None
+        self.transport          = None
+        self.robot_on           = False
+        self.loop               = asyncio.new_event_loop()
+        self.thread             = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        create = self.loop.create_server(lambda: RobotProtocol(self), \
+                    parms['serverIP'], parms['serverPort'])
+        try:
+            self.server = asyncio.run_coroutine_threadsafe(create, self.loop).result()
+        except OSError as e:
+            print("!ERROR! "+str(e))
+            self.stop()
+            return -1
+        return 0
+
+    # Runs on the event loop, stop listening and drop the robot connection
+    async def __closeServer(self):
+        self.server.close()
+        if self.transport is not None:
+            self.transport.close()
+        await self.server.wait_closed()
+        self.server = None
+
     #==============================================================================
     #
     # Get data from robot
@@ -49,10 +299,64 @@ class RobotServer:
     # then turn to a new heading and goto step 4.
     #==============================================================================
     def getDataFromRobot(self, parameters, dtext):
-        return self.get_robot_data(parameters, dtext)
+        with Instrumentation.span('robotData'):
+            state = self.get_robot_data(parameters, dtext)
+        Instrumentation.count('idlePolls' if state == 'idle' else 'robotMessages')
+        if self.record is not None and state != 'idle':
+            with Instrumentation.span('record'):
+                self.__recordFrame(parameters, state)
+        return state
+
+    # Returns 'init', 'update' or 'idle' if no frame arrived within serverTimeout
+    def __getDataFromRealRobot(self, parms, dtext):
+        try:
+            slot = self.frames.get(timeout=self.timeout)
+        except queue.Empty:
+            dtext.append(("idle", False))
+            return 'idle'
+        # The previous frame is no longer used by the filter
+        if self.current_slot is not None:
+            self.loop.call_soon_threadsafe(self.__releaseSlot, self.current_slot)
+        self.current_slot = slot
+        return self.__decodeFrame(parms, self.buffers[slot], self.lidar_views[slot], dtext)
+
+    # Returns the next recorded frame, 'idle' after the last one
+    def __getDataFromReplay(self, parms, dtext):
+        if self.replay_next >= len(self.replay_frames):
+            self.finished               = True
+            dtext.append(("end of replay", False))
+            return 'idle'
+        frame                           = self.replay_frames[self.replay_next]
+        self.replay_next               += 1
+        return self.__decodeFrame(parms, frame, frame[FRAME_HEADER.size:].view('<u2'), dtext)
 
-    def __getDataFromRealRobot(self, parameters, dtext):
-        pass
+    def __decodeFrame(self, parms, frame, lidar_data, dtext):
+        (msg_type, flags, count, heading, distance, tx, ty) = FRAME_HEADER.unpack_from(frame)
+        if self.record is not None:
+            self.frame                  = bytes(frame)
+        parms['robotHeading']           = heading
+        parms['robotLidarData']         = lidar_data
+        parms['robotValidLidar']        = bool((lidar_data < parms['lidarMaxDistance']-1).any())
+        truth                           = not (math.isnan(tx) or math.isnan(ty))
+        if msg_type == MSG_INIT or not self.robot_on:
+            # 3) The robot sends the "init" command followed by the magnetometer and Lidar data
+            self.robot_on               = True
+            if truth:
+                parms['simulatedRobotPath'] = [(int(tx), int(ty))]
+            dtext.append(("init h=%f" % heading, True)) # Display to console and overlay
+            return 'init'
+        # 5) The robot sends the "update" command followed by x, z, and the Lidar data
+        parms['robotDistance']          = int(round(distance / parms['distanceToPixel']))
+        if truth and 'simulatedRobotPath' in parms:
+            parms['simulatedRobotPath'].append((int(tx), int(ty)))
+            dtext.append(("sr=%d,%d" % (int(tx), int(ty)), True)) # Display to console and overlay
+        return 'update'
+
+    def __releaseSlot(self, slot):
+        if self.protocol is not None:
+            self.protocol.releaseSlot(slot)
+        else:
+            self.free_slots.append(slot)
 
     def __getDataFromSimulatedRobot(self, parms, dtext):
         if self.robot_on == False:
@@ -65,7 +369,7 @@ class RobotServer:
             # 3) The robot sends the "init" command followed by the magnetometer and Lidar data
             robot_heading  = 0
             if 'robotX' not in parms:
-                x, y = random.choice(parms['arena'].valid_regions)
+                x, y = (int(v) for v in random.choice(parms['arena'].valid_regions))
                 robot_heading = random.random()*(2 * math.pi)
             else:
                 try:
@@ -78,7 +382,8 @@ class RobotServer:
             self.robot_on                   = True
             status                          = 0
             parms['robotHeading']           = robot_heading
-            parms['robotValidLidar']        = self.arena.readLidar(x, y, parms['robotLidarData'])
+            parms['robotValidLidar']        = self.arena.readLidar(x, y, parms['robotLidarData'], \
+                                                heading=parms['robotHeading'])
             parms['simulatedRobotPath']     = [(x,y)]
             dtext.append(("init r=%d,%d" % (x, y), True)) # Display to console and overlay
             return 'init'
@@ -90,27 +395,27 @@ class RobotServer:
             update_dist                     = parms['robotDistBetUpdates']
             lidar_data                      = parms['robotLidarData']
             x,y                             = parms['simulatedRobotPath'][-1]
-            valid                           = self.arena.readLidar(x, y, lidar_data, 4)
+            valid                           = self.arena.readLidar(x, y, lidar_data, 4, heading=parms['robotHeading'])
             if lidar_data[0] <= 1:
                 dtext.append(("New heading", False))
-                valid                       = self.arena.readLidar(x, y, lidar_data)
+                valid                       = self.arena.readLidar(x, y, lidar_data, heading=parms['robotHeading'])
                 self.__setNewHeading(parms, lidar_data, update_dist, dtext)
             # try to move
             for step in range(update_dist):
                 tx = x + step * math.cos(parms['robotHeading'])
                 ty = y + step * math.sin(parms['robotHeading'])
-                valid = self.arena.readLidar(tx, ty, lidar_data, 4)
+                valid = self.arena.readLidar(tx, ty, lidar_data, 4, heading=parms['robotHeading'])
                 if lidar_data[0] <= 1:
                     break
             x = tx
             y = ty
-            valid                           = self.arena.readLidar(x, y, lidar_data)
+            valid                           = self.arena.readLidar(x, y, lidar_data, heading=parms['robotHeading'])
             parms['robotDistance']          = int(round(random.normalvariate(step, \
                                                 parms['distanceSigmaNoise'])))
             dtext.append(("sr=%d,%d" % (int(x), int(y)), True)) # Display to console and overlay
             parms['simulatedRobotPath'].append((int(x), int(y)))
             parms['robotValidLidar']        = self.arena.readLidar(int(x), int(y), \
-                                                parms['robotLidarData'])
+                                                parms['robotLidarData'], heading=parms['robotHeading'])
             return 'update'
 
     def __setNewHeading(self, parms, lidar_data, update_dist, dtext):
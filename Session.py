@@ -0,0 +1,150 @@
+# Experiments in robot localization using particle filters (algorithm and simulator)
+# Copyright (C) <2021>  Eric Gregori
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import time
+import Instrumentation
+import RobotServer as rs
+import TrackingFilter
+
+# Per robot file name with more than one robot, robot1_name, ...
+def robotFilename(parms, filename, robot_id):
+    if parms['robots'] == 1: return filename
+    (head, tail) = os.path.split(filename)
+    return os.path.join(head, "robot%d_"%robot_id + tail)
+
+#==============================================================================
+#
+# Session - localize one robot
+#
+#   Each session has its own copy of the parameters, its own robot server
+#   and its own particle filter (parms['pfObject']). The Arena and everything
+#   it precomputed (valid regions, scan table, distance field) is shared by
+#   all sessions.
+#
+#   With a real robot, session robot_id listens on serverPort + robot_id.
+#   Record and replay files are per robot, see robotFilename().
+#
+#   Scheduling policy (sessionPolicy):
+#       'fair'       - the session is charged the time its filter takes
+#                      divided by sessionShare, so a slow filter gets fewer
+#                      turns and can not starve the other robots.
+#       'roundrobin' - the session is charged the average step time of all
+#                      sessions, one turn per round however slow it is.
+#
+#   sessionPolicy and sessionShare are either one value for all robots or a
+#   list with one value per robot.
+#
+#==============================================================================
+class Session:
+    # poll - do not wait for the robot, a robot without data must not hold
+    #        up the other sessions (serverTimeout 0)
+    def __init__(self, parms, robot_id, poll=False):
+        self.parms              = dict(parms)
+        self.robot_id           = robot_id
+        if poll:
+            self.parms['serverTimeout'] = 0
+        self.policy             = self.__perRobot(parms['sessionPolicy'])
+        self.share              = float(self.__perRobot(parms['sessionShare']))
+        self.iteration          = 0
+        self.virtual_time       = 0.0
+        self.prediction         = (0,0,0)
+        self.state              = None      # Last message from the robot
+        self.elapsed_time       = 0.0       # Seconds for the last step
+        if 'serverIP' in parms:
+            self.parms['serverPort'] = parms['serverPort'] + robot_id
+        for name in ('recordFilename', 'replayFilename'):
+            if name in parms:
+                self.parms[name] = robotFilename(parms, parms[name], robot_id)
+        self.robot_server       = rs.RobotServer(self.parms)
+
+    def __perRobot(self, value):
+        if isinstance(value, (list, tuple)): return value[self.robot_id]
+        return value
+
+    def start(self):
+        return self.robot_server.start(self.parms)
+
+    def done(self):
+        return self.iteration >= self.parms['iterations'] or self.robot_server.finished
+
+    # Run one filter iteration
+    # Returns (iteration, dtext), iteration is None if there was no data from the robot
+    def step(self, prefix=""):
+        dtext = [(prefix+"Iteration %d"%self.iteration,False)] # Only output to console
+        with Instrumentation.span('filter') as span:
+            state = self.robot_server.getDataFromRobot(self.parms, dtext)
+            self.prediction = TrackingFilter.particleFilter(self.parms, state, dtext)
+        elapsed_time = span.elapsed
+        dtext.append(("TT:%f"%elapsed_time,False))
+        self.state = state
+        self.elapsed_time = elapsed_time
+        if state == 'idle':
+            return (None, dtext), elapsed_time
+        self.iteration += 1
+        return (self.iteration - 1, dtext), elapsed_time
+
+    def close(self):
+        self.robot_server.stop()
+        if 'pfObject' in self.parms:
+            self.parms['pfObject'].close()
+
+#==============================================================================
+#
+# SessionManager - localize parms['robots'] robots in one process
+#
+#   The sessions are stepped one at a time, the next session is the one with
+#   the least virtual time (stride scheduling).
+#
+#==============================================================================
+class SessionManager:
+    def __init__(self, parms):
+        poll                    = parms['robots'] > 1
+        self.sessions           = [Session(parms, i, poll) for i in range(parms['robots'])]
+        self.average_step       = 0.0
+        self.steps              = 0
+        self.idle               = 0
+
+    def start(self):
+        for session in self.sessions:
+            if session.start() < 0: return -1
+        return 0
+
+    def done(self):
+        return all(session.done() for session in self.sessions)
+
+    # Step the next session
+    # Returns (session, iteration, dtext), iteration is None if the robot had no data
+    def step(self):
+        session = min((s for s in self.sessions if not s.done()), key=lambda s: s.virtual_time)
+        prefix = "R%d "%session.robot_id if len(self.sessions) > 1 else ""
+        (iteration, dtext), elapsed_time = session.step(prefix)
+        self.steps += 1
+        self.average_step += (elapsed_time - self.average_step) / self.steps
+        if session.policy == 'roundrobin' or iteration is None:
+            session.virtual_time += self.average_step
+        else:
+            session.virtual_time += elapsed_time / session.share
+        # Every robot polled without data, wait a little
+        self.idle = self.idle + 1 if iteration is None else 0
+        if self.idle >= len(self.sessions):
+            time.sleep(0.001)
+            self.idle = 0
+        return session, iteration, dtext
+
+    def close(self):
+        for session in self.sessions:
+            session.close()
@@ -8,8 +8,13 @@ import Algorithm as alg
 #==============================================================================
 def particleFilter(parameters, state, dtext):
     prediction = (0,0,0)
+    if state == 'idle' or (state != 'init' and 'pfObject' not in parameters):
+        # No data from the robot, keep the last prediction
+        return parameters.get('pfPrediction', prediction)
     if state == 'init':
         # Place initial particles
+        if 'pfObject' in parameters:
+            parameters['pfObject'].close()
         parameters['pfObject'] = alg.ParticleFilter(parameters)
         dtext.append(("Place particles", True)) # Display to console and overlay
         (done, nump, avgw, keep, prediction) = parameters['pfObject'].pfData()
@@ -19,4 +24,5 @@ def particleFilter(parameters, state, dtext):
         dtext.append(("wavg=%2f"%avgw, True))
         if prediction[2] > 0:
             dtext.append(("L=%d,%d"%(prediction[0],prediction[1]), True))
+    parameters['pfPrediction'] = prediction
     return prediction
@@ -0,0 +1,116 @@
+# Experiments in robot localization using particle filters (algorithm and simulator)
+# Copyright (C) <2021>  Eric Gregori
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+import Arena
+import LidarBotModel as model
+import Instrumentation
+
+#==============================================================================
+#
+# WorkerPool - move and weigh particles in worker processes
+#
+#   The particles are split into shards of workerShardSize particles and
+#   the shards are run by a pool of worker processes. Each worker attaches
+#   to the arena through shared memory (Arena.share), so only the particle
+#   arrays are sent to the workers and returned.
+#
+#   Each shard draws its motion noise from its own random stream, seeded
+#   from (seed, update count, shard). With the same randomSeed a run is
+#   reproducible for any number of workers.
+#
+#==============================================================================
+
+# Parameters a worker needs to build a ParticleSet
+STATIC_PARAMETERS = ('lidarMaxDistance', 'lidarSamples', 'sensorModel', 'weightModel',
+                     'headingSource', 'headingSearchWindow', 'measurementSigmaNoise',
+                     'headingSigmaNoise', 'distanceSigmaNoise', 'likelihoodSigmaNoise')
+# Parameters that change with every robot update
+UPDATE_PARAMETERS = ('robotHeading', 'robotDistance', 'robotLidarData', 'robotValidLidar')
+
+worker_parameters = None # Set in each worker process by initWorker
+
+# A forked worker would inherit the parent's recorder, its counts are
+# returned with each task instead
+def initWorker(description, parameters):
+    global worker_parameters
+    Instrumentation.recorder        = Instrumentation.Counter()
+    worker_parameters               = dict(parameters)
+    worker_parameters['randomSeed'] = None
+    worker_parameters['arena']      = Arena.Arena.attach(description, worker_parameters)
+
+def runShard(task):
+    (operation, seed, update, shard, robot, blocked, x, y, heading, weight) = task
+    parms = worker_parameters
+    parms.update(robot)
+    rng = np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(update, shard)))
+    pset = model.ParticleSet(parms, rng=rng)
+    pset.add(x, y, weigh=False)
+    pset.heading[:] = heading
+    pset.weight[:] = weight
+    pset.robot_blocked = blocked
+    if operation == 'move':
+        pset.move()
+    else:
+        pset.weigh()
+    return (pset.x, pset.y, pset.heading, pset.weight, pset.samples, pset.valid, pset.robot_blocked,
+            Instrumentation.recorder.take())
+
+class WorkerPool:
+    def __init__(self, parms, rng):
+        self.workers            = parms['workers']
+        self.shard_size         = max(1, parms['workerShardSize'])
+        self.arena              = parms['arena']
+        self.seed               = int(rng.integers(2**63))
+        self.update_count       = 0
+        static                  = {k: parms[k] for k in STATIC_PARAMETERS}
+        print("Starting %d workers" % self.workers)
+        self.executor           = ProcessPoolExecutor(self.workers, initializer=initWorker,
+                                    initargs=(self.arena.share(), static))
+
+    # Same as pset.move()
+    def move(self, pset, parms):
+        self.__run('move', pset, parms)
+
+    # Same as pset.weigh()
+    def weigh(self, pset, parms):
+        self.__run('weigh', pset, parms)
+
+    def __run(self, operation, pset, parms):
+        self.update_count += 1
+        robot = {k: parms[k] for k in UPDATE_PARAMETERS if k in parms}
+        starts = range(0, len(pset), self.shard_size)
+        tasks = [(operation, self.seed, self.update_count, shard, robot, pset.robot_blocked,
+                  pset.x[b:b+self.shard_size], pset.y[b:b+self.shard_size],
+                  pset.heading[b:b+self.shard_size], pset.weight[b:b+self.shard_size])
+                 for shard, b in enumerate(starts)]
+        results = self.executor.map(runShard, tasks)
+        for b, (x, y, heading, weight, samples, valid, blocked, counts) in zip(starts, results):
+            e = b + len(x)
+            pset.x[b:e]         = x
+            pset.y[b:e]         = y
+            pset.heading[b:e]   = heading
+            pset.weight[b:e]    = weight
+            pset.samples[b:e]   = samples
+            pset.valid[b:e]     = valid
+            pset.robot_blocked  = blocked
+            for name, n in counts.items():
+                Instrumentation.count(name, n)
+
+    def close(self):
+        self.executor.shutdown()
+        self.arena.unshare()
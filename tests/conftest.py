@@ -0,0 +1,92 @@
+# Experiments in robot localization using particle filters (algorithm and simulator)
+# Copyright (C) <2021>  Eric Gregori
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import sys
+import math
+import random
+import contextlib
+import io
+import numpy as np
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import Configuration
+import Arena
+import Session
+
+#==============================================================================
+#
+# Fixtures - floorplan.png with the default parameters, caches in a
+# temporary directory
+#
+#==============================================================================
+def quiet(function):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return function()
+
+@pytest.fixture(scope='session')
+def cache_directory(tmp_path_factory):
+    return str(tmp_path_factory.mktemp('cache'))
+
+def defaultParameters(cache_directory):
+    parameters = dict()
+    Configuration.Configuration(parameters)
+    parameters['arenaFilename']     = os.path.join(ROOT, 'floorplan.png')
+    parameters['cacheDirectory']    = cache_directory
+    parameters['randomSeed']        = 1
+    return parameters
+
+@pytest.fixture(scope='session')
+def arena(cache_directory):
+    return quiet(lambda: Arena.Arena(defaultParameters(cache_directory)))
+
+# Default parameters with the shared arena
+@pytest.fixture
+def parameters(cache_directory, arena):
+    parameters = defaultParameters(cache_directory)
+    parameters['arena']             = arena
+    parameters['arenaHeight']       = arena.height
+    parameters['arenaWidth']        = arena.width
+    return parameters
+
+# Run the filter on the simulated robot, returns the distance between the
+# prediction and the robot for every iteration with a prediction. With a
+# spreads list, the median distance of the particles to the robot is added
+# to it for the same iterations.
+def track(parameters, iterations, x=250, y=200, h=0.0, seed=0, spreads=None):
+    parameters = dict(parameters, robotX=x, robotY=y, robotH=h, iterations=iterations,
+                      numberOfParticles=parameters['numberOfParticles'] or 200,
+                      initialWeightThres=0.8)
+    random.seed(seed)
+    session = quiet(lambda: Session.Session(parameters, 0))
+    errors = []
+    try:
+        quiet(session.start)
+        while not session.done():
+            (iteration, dtext), elapsed_time = quiet(session.step)
+            px, py, radius = session.prediction
+            if iteration and radius > 0:
+                rx, ry = session.parms['simulatedRobotPath'][-1]
+                errors.append(math.hypot(px - rx, py - ry))
+                if spreads is not None:
+                    particles = session.parms['pfObject'].particles
+                    spreads.append(float(np.median(np.hypot(particles.x - rx, particles.y - ry))))
+    finally:
+        session.close()
+    return errors
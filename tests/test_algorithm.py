@@ -0,0 +1,117 @@
+# Experiments in robot localization using particle filters (algorithm and simulator)
+# Copyright (C) <2021>  Eric Gregori
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import statistics
+import numpy as np
+import pytest
+import Algorithm
+import Instrumentation
+import Session
+from conftest import quiet
+
+# Upper 0.99 quantiles of the chi-square distribution by degrees of freedom
+CHI2_99 = {1: 6.635, 4: 13.277, 9: 21.666, 29: 49.588, 99: 134.642}
+
+# The KLD-sampling count approximates chi2(k-1, 1-delta) / (2 epsilon)
+@pytest.mark.parametrize('k', sorted(d + 1 for d in CHI2_99))
+def test_kld_particles(k):
+    z = statistics.NormalDist().inv_cdf(0.99)
+    n = Algorithm.kldParticles(k, 0.05, z)
+    assert n == pytest.approx(CHI2_99[k - 1] / 0.1, rel=0.02)
+
+def test_kld_particles_one_bin():
+    assert Algorithm.kldParticles(0, 0.05, 2.0) == 0
+    assert Algorithm.kldParticles(1, 0.05, 2.0) == 0
+
+def test_kld_particles_grow_with_bins():
+    counts = [Algorithm.kldParticles(k, 0.05, 2.0) for k in range(2, 50)]
+    assert counts == sorted(counts)
+
+# The coarse level scores one hypothesis per cell of 2x2 valid regions and
+# most of the time still places a particle at the robot
+def test_pyramid(parameters, arena):
+    regions = np.asarray(arena.valid_regions).reshape(-1, 2)
+    parameters.update(globalLocalization='pyramid', initialWeightThres=0.8, robotHeading=0.3,
+                      robotLidarData=[0] * parameters['lidarSamples'])
+    found = []
+    for x, y in regions[::97]:
+        parameters['robotValidLidar'] = arena.readLidar(x, y, parameters['robotLidarData'], heading=0.3)
+        Instrumentation.recorder = Instrumentation.Counter()
+        try:
+            particles = quiet(lambda: Algorithm.ParticleFilter(parameters)).particles
+            counts = Instrumentation.recorder.take()
+        finally:
+            Instrumentation.recorder = None
+        assert 0 < counts['pyramidHypotheses'] < len(regions) / 3
+        found.append(np.any((particles.x == x) & (particles.y == y)))
+    assert np.mean(found) >= 0.75
+
+# Robot data for a scan from x, y
+def robotAt(parameters, arena, x, y, heading=0.0):
+    parameters.update(robotHeading=heading, robotDistance=0,
+                      robotLidarData=[0] * parameters['lidarSamples'])
+    parameters['robotValidLidar'] = arena.readLidar(x, y, parameters['robotLidarData'], heading=heading)
+
+# Tracking mode starts once the filter has converged on the simulated robot
+def test_tracking_mode_engages(parameters):
+    parameters.update(trackingMode=True, robotX=250, robotY=200, robotH=0.0, iterations=40,
+                      numberOfParticles=200, initialWeightThres=0.8)
+    session = quiet(lambda: Session.Session(parameters, 0))
+    tracking = []
+    try:
+        quiet(session.start)
+        while not session.done():
+            quiet(session.step)
+            tracking.append(session.parms['pfObject'].tracking is not None)
+    finally:
+        session.close()
+    assert any(tracking)
+
+# A reset while tracking only places particles within trackingWindow of the
+# estimate
+def test_tracking_reset_in_window(parameters, arena):
+    x, y = 250, 200
+    parameters.update(trackingMode=True, trackingWindow=40, initialWeightThres=0.8)
+    robotAt(parameters, arena, x, y)
+    pf = quiet(lambda: Algorithm.ParticleFilter(parameters))
+    assert np.any((np.abs(pf.particles.x - x) > 40) | (np.abs(pf.particles.y - y) > 40))
+    pf.tracking = (x, y)
+    pf.particles.keep(np.zeros(len(pf.particles), dtype=bool))
+    quiet(lambda: pf.update(parameters, []))
+    assert pf.tracking is not None
+    assert len(pf.particles) > 0
+    assert np.all(np.abs(pf.particles.x - x) <= 40) and np.all(np.abs(pf.particles.y - y) <= 40)
+
+# The filter goes back to global mode when the robot is not where it is
+# tracked: the average weight drops, or the local reset finds nothing
+def test_tracking_falls_back_to_global(parameters, arena):
+    regions = np.asarray(arena.valid_regions).reshape(-1, 2)
+    far = regions[np.argmax(np.hypot(regions[:,0] - 250, regions[:,1] - 200))]
+    parameters.update(trackingMode=True, trackingWindow=40, initialWeightThres=0.8)
+    robotAt(parameters, arena, 250, 200)
+    pf = quiet(lambda: Algorithm.ParticleFilter(parameters))
+    pf.tracking = (250, 200)
+    pf.particles.keep(np.zeros(len(pf.particles), dtype=bool))
+    quiet(lambda: pf.update(parameters, []))
+    assert pf.tracking is not None
+    robotAt(parameters, arena, *far)
+    quiet(lambda: pf.update(parameters, []))
+    assert pf.tracking is None
+    pf.tracking = (250, 200)
+    pf.particles.keep(np.zeros(len(pf.particles), dtype=bool))
+    quiet(lambda: pf.update(parameters, []))
+    assert pf.tracking is None
+    assert np.any(np.hypot(pf.particles.x - far[0], pf.particles.y - far[1]) < 20)
@@ -0,0 +1,82 @@
+# Experiments in robot localization using particle filters (algorithm and simulator)
+# Copyright (C) <2021>  Eric Gregori
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import numpy as np
+import Arena
+from conftest import quiet, defaultParameters
+
+# The valid regions read from the cache are the ones found in the image
+def test_region_cache(tmp_path):
+    parameters = defaultParameters(str(tmp_path))
+    built = quiet(lambda: Arena.Arena(dict(parameters)))
+    names = sorted(os.listdir(str(tmp_path)))
+    assert any(name.startswith('regions_') for name in names)
+    cached = quiet(lambda: Arena.Arena(dict(parameters)))
+    assert sorted(os.listdir(str(tmp_path))) == names
+    uncached = quiet(lambda: Arena.Arena(dict(parameters, regionCache=False)))
+    for arena in (built, cached):
+        assert np.array_equal(arena.valid_regions, uncached.valid_regions)
+
+def allCells(arena):
+    y, x = np.mgrid[0:arena.height, 0:arena.width]
+    return x.reshape(-1), y.reshape(-1)
+
+# The occupancy grid read from the cache is the one built from the image
+def test_occupancy_cache(tmp_path):
+    parameters = defaultParameters(str(tmp_path))
+    built = quiet(lambda: Arena.Arena(dict(parameters)))
+    names = sorted(os.listdir(str(tmp_path)))
+    assert any(name.startswith('occupancy_') for name in names)
+    cached = quiet(lambda: Arena.Arena(dict(parameters)))
+    assert sorted(os.listdir(str(tmp_path))) == names
+    uncached = quiet(lambda: Arena.Arena(dict(parameters, occupancyCache=False)))
+    x, y = allCells(uncached)
+    for arena in (built, cached):
+        assert np.array_equal(arena.checkXYBatch(x, y), uncached.checkXYBatch(x, y))
+        assert arena.map_hash == uncached.map_hash
+
+# A scan table with stride 1 reads the same scans as ray casting, poses
+# anywhere in the arena (walls too) and any heading. The table is built for
+# a corner of the floorplan, saved as a .npy occupancy grid.
+def test_scan_table_matches_ray_casting(arena, tmp_path):
+    y, x = np.mgrid[0:160, 0:240]
+    filename = str(tmp_path / "corner.npy")
+    np.save(filename, arena.checkXYBatch(x, y))
+    parameters = dict(defaultParameters(str(tmp_path)), arenaFilename=filename)
+    cast = quiet(lambda: Arena.Arena(dict(parameters)))
+    table = quiet(lambda: Arena.Arena(dict(parameters, scanTable=True, scanTableStride=1)))
+    rng = np.random.default_rng(6)
+    xs = rng.integers(0, cast.width, 500)
+    ys = rng.integers(0, cast.height, 500)
+    heading = rng.uniform(0, 2 * np.pi, 500)
+    expected, expected_valid = cast.readLidarBatch(xs, ys, heading)
+    samples, valid = table.readLidarBatch(xs, ys, heading)
+    assert np.array_equal(samples, expected)
+    assert np.array_equal(valid, expected_valid)
+
+# The memo returns the same scans as ray casting, also for repeated poses
+def test_memo_matches_uncached(arena):
+    rng = np.random.default_rng(5)
+    regions = np.asarray(arena.valid_regions).reshape(-1, 2)
+    poses = regions[rng.integers(0, len(regions), 50)]
+    xs = np.concatenate((poses[:,0], poses[:10,0]))
+    ys = np.concatenate((poses[:,1], poses[:10,1]))
+    for heading in (0.0, 1.0, 1.0, rng.choice([0.0, 0.5], len(xs))):
+        expected, expected_valid = arena.readLidarBatch(xs, ys, heading)
+        samples, valid = arena.readLidarMemo(xs, ys, heading)
+        assert np.array_equal(samples, expected)
+        assert np.array_equal(valid, expected_valid)
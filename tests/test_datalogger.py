@@ -0,0 +1,65 @@
+# Experiments in robot localization using particle filters (algorithm and simulator)
+# Copyright (C) <2021>  Eric Gregori
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import numpy as np
+import DataLogger
+
+def records(dtype, count):
+    data = np.zeros(count, dtype=dtype)
+    data['iteration'] = np.arange(count)
+    data['robotLidar'] = np.arange(count)[:,None] + np.arange(dtype['robotLidar'].shape[0])
+    data['TT'] = np.linspace(0.0, 1.0, count)
+    return data
+
+# The .npy header is rewritten on every flush, the file loads with the
+# records written so far
+def test_logfile_round_trip(tmp_path):
+    filename = str(tmp_path / "log.npy")
+    dtype = DataLogger.recordType(36)
+    data = records(dtype, 11)
+    log = DataLogger.LogFile(filename, dtype, 4)
+    log.append(data[:5])
+    assert np.array_equal(np.load(filename), data[:4])
+    record = log.next()
+    for name in dtype.names:
+        record[name] = data[5][name]
+    log.append(data[6:])
+    log.close()
+    loaded, particles = DataLogger.loadLog(filename)
+    assert loaded.dtype == dtype
+    assert np.array_equal(loaded, data)
+    assert particles is None
+
+# A record that is only partly filled in does not keep the fields of the
+# record that used its chunk row before
+def test_logfile_next_is_zeroed(tmp_path):
+    filename = str(tmp_path / "log.npy")
+    dtype = DataLogger.recordType(36)
+    log = DataLogger.LogFile(filename, dtype, 1)
+    record = log.next()
+    record['iteration'] = 1
+    record['particles'] = 200
+    record['predictionX'] = 120
+    log.next()['iteration'] = 2
+    log.close()
+    loaded = np.load(filename)
+    assert list(loaded['iteration']) == [1, 2]
+    assert loaded['particles'][1] == 0 and loaded['predictionX'][1] == 0
+
+def test_logfile_empty(tmp_path):
+    filename = str(tmp_path / "log.npy")
+    DataLogger.LogFile(filename, DataLogger.PARTICLE_TYPE, 8).close()
+    assert len(np.load(filename)) == 0
@@ -0,0 +1,46 @@
+# Experiments in robot localization using particle filters (algorithm and simulator)
+# Copyright (C) <2021>  Eric Gregori
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import numpy as np
+import Display
+
+def snap(tmp_path, path, length=None):
+    return {'filename': str(tmp_path / "frame"), 'text': [], 'point': (0, 0, 0), 'particles': None,
+            'path': path, 'pathLength': len(path) if length is None else length}
+
+def frame(display):
+    return display._Display__image
+
+# A new robot path removes the old one from the background
+def test_new_path_clears_the_old_one(parameters, tmp_path):
+    display = Display.Display(parameters)
+    empty = frame(display).copy()
+    old = [(100, 100), (200, 100), (200, 200)]
+    display.draw(snap(tmp_path, old))
+    assert np.any(frame(display)[100, 120:180] != empty[100, 120:180])
+    display.draw(snap(tmp_path, [(400, 300), (450, 300)]))
+    assert np.array_equal(frame(display)[95:205, 95:205], empty[95:205, 95:205])
+    assert np.any(frame(display)[300, 410:440] != empty[300, 410:440])
+
+# The same path drawn again from the start, a shorter path length
+def test_shorter_path_clears_the_old_one(parameters, tmp_path):
+    display = Display.Display(parameters)
+    empty = frame(display).copy()
+    path = [(100, 100), (200, 100), (200, 200)]
+    display.draw(snap(tmp_path, path))
+    display.draw(snap(tmp_path, path, 2))
+    assert np.array_equal(frame(display)[110:205, 195:205], empty[110:205, 195:205])
+    assert np.any(frame(display)[100, 120:180] != empty[100, 120:180])
@@ -0,0 +1,132 @@
+# Experiments in robot localization using particle filters (algorithm and simulator)
+# Copyright (C) <2021>  Eric Gregori
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import numpy as np
+import pytest
+import LidarBotModel as model
+
+@pytest.fixture
+def particles(parameters):
+    parameters['robotHeading'] = 0.0
+    return model.ParticleSet(parameters, rng=np.random.default_rng(3))
+
+# Low variance resampling draws each particle count * weight / total times,
+# rounded up or down, and never a particle without weight
+def test_resample_counts(particles):
+    weight = np.array([0.0, 1.0, 3.0, 0.5, 0.0, 2.5])
+    particles.add(np.arange(len(weight)) * 10 + 100, np.full(len(weight), 100), weigh=False)
+    particles.weight[:] = weight
+    ids = particles.ids.copy()
+    assert particles.resample(70)
+    counts = np.array([np.sum(particles.ids == i) for i in ids])
+    expected = 70 * weight / weight.sum()
+    assert counts.sum() == 70
+    assert np.all(counts >= np.floor(expected)) and np.all(counts <= np.ceil(expected))
+    assert np.all(counts[weight == 0] == 0)
+
+def test_resample_without_weight(particles):
+    particles.add([100, 110], [100, 100], weigh=False)
+    assert not particles.resample(10)
+    assert len(particles) == 2
+
+# A particle view can not move alone, the set is left as it was
+def test_particle_view_move(particles):
+    particles.add([100, 110], [100, 100], weigh=False)
+    with pytest.raises(Exception, match="ParticleSet.move"):
+        particles[0].move()
+    assert list(particles.x) == [100, 110]
+
+# Per particle motion, as Particle.move did before the batched move: before
+# each one pixel step the pixel one ahead on the heading beam is probed, the
+# particle stops at the first probe that hits a wall
+def moveOne(arena, x, y, beam, dx, dy):
+    (xa, ya) = arena.scan_points[beam][1]
+    sx, sy = 0.0, 0.0
+    for i in range(len(dx)):
+        if arena.CheckXY(x + sx + xa, y + sy + ya): return int(x + sx), int(y + sy), True
+        sx += float(dx[i])
+        sy += float(dy[i])
+    return int(x + sx), int(y + sy), False
+
+# The batched move, with its clearance shortcut and swept probes, moves and
+# stops every particle as the per particle loop with the same noise
+@pytest.mark.parametrize('heading', [0.0, 1.3, 3.5])
+def test_move_matches_per_particle(parameters, arena, heading):
+    regions = np.asarray(arena.valid_regions).reshape(-1, 2)
+    parameters.update(robotHeading=heading, robotDistance=21, robotValidLidar=True,
+                      robotLidarData=[10] * parameters['lidarSamples'])
+    particles = model.ParticleSet(parameters, rng=np.random.default_rng(5))
+    particles.add(regions[::3,0], regions[::3,1], weigh=False)
+    x0, y0 = particles.x.copy(), particles.y.copy()
+    collision = particles.move()
+    # The same draws as the batched move
+    rng = np.random.default_rng(5)
+    n = len(x0)
+    steps = np.round(rng.normal(21, parameters['distanceSigmaNoise'], n)).astype(np.intp)
+    h = rng.standard_normal((n, steps.max()), dtype=np.float32)
+    h *= np.float32(parameters['headingSigmaNoise'])
+    h += np.float32(heading)
+    beam = int(heading / (2 * np.pi / parameters['lidarSamples'])) % parameters['lidarSamples']
+    for i in range(n):
+        expected = moveOne(arena, x0[i], y0[i], beam, np.cos(h[i,:steps[i]]), np.sin(h[i,:steps[i]]))
+        assert (particles.x[i], particles.y[i], collision[i]) == expected
+    assert 0 < collision.sum() < n
+
+def test_correlation_weights_match_corrcoef():
+    rng = np.random.default_rng(0)
+    robot = rng.integers(0, 50, 36)
+    samples = rng.integers(0, 50, (20, 36))
+    expected = [np.corrcoef(robot, s)[0][1] for s in samples]
+    assert np.allclose(model.correlationWeights(robot, samples), expected)
+
+def test_correlation_weights_constant_scan():
+    weights = model.correlationWeights(np.arange(36), np.full((1, 36), 49))
+    assert np.isnan(weights[0])
+
+# Brute force: every rotation of every scan against the robot scan
+def bruteForce(robot, samples, shifts):
+    scores = np.array([[np.corrcoef(robot, np.roll(s, -k))[0][1] for k in shifts] for s in samples])
+    return np.asarray(shifts)[scores.argmax(axis=1)], scores.max(axis=1)
+
+def test_heading_search_matches_brute_force():
+    rng = np.random.default_rng(1)
+    robot = rng.integers(0, 50, 36)
+    samples = rng.integers(0, 50, (20, 36))
+    shift, score = model.headingSearch(robot, samples)
+    expected_shift, expected_score = bruteForce(robot, samples, range(36))
+    assert np.array_equal(shift, expected_shift)
+    assert np.allclose(score, expected_score)
+
+def test_heading_search_finds_the_rotation():
+    rng = np.random.default_rng(2)
+    samples = rng.integers(0, 50, (10, 36))
+    turns = rng.integers(0, 36, 10)
+    for sample, turn in zip(samples, turns):
+        shift, score = model.headingSearch(np.roll(sample, -turn), sample[None,:])
+        assert shift[0] == turn
+        assert np.isclose(score[0], 1.0)
+
+def test_heading_search_window():
+    rng = np.random.default_rng(4)
+    robot = rng.integers(0, 50, 36)
+    samples = rng.integers(0, 50, (20, 36))
+    around = rng.integers(0, 36, 20)
+    shift, score = model.headingSearch(robot, samples, around, 2)
+    for i in range(len(samples)):
+        shifts = [(around[i] + d) % 36 for d in range(-2, 3)]
+        expected_shift, expected_score = bruteForce(robot, samples[i:i+1], shifts)
+        assert shift[i] == expected_shift[0]
+        assert np.isclose(score[i], expected_score[0])
@@ -0,0 +1,87 @@
+# Experiments in robot localization using particle filters (algorithm and simulator)
+# Copyright (C) <2021>  Eric Gregori
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import random
+import numpy as np
+import RobotServer as rs
+import Session
+from conftest import quiet
+
+# Robot messages from a simulated run, then from its replay
+def robotMessages(parameters, iterations):
+    server = rs.RobotServer(parameters)
+    assert quiet(lambda: server.start(parameters)) == 0
+    messages = []
+    try:
+        for i in range(iterations):
+            state = quiet(lambda: server.getDataFromRobot(parameters, []))
+            if state == 'idle': break
+            messages.append((state, parameters['robotHeading'], parameters.get('robotDistance'),
+                             list(parameters['robotLidarData']), parameters['robotValidLidar'],
+                             parameters['simulatedRobotPath'][-1]))
+    finally:
+        server.stop()
+    return messages
+
+# The replay decodes the messages the simulated robot sent, heading to
+# float32 precision
+def test_record_replay(parameters, tmp_path):
+    filename = str(tmp_path / "run.rep")
+    random.seed(0)
+    recorded = robotMessages(dict(parameters, robotX=250, robotY=200, robotH=0.0,
+                                  recordFilename=filename), 20)
+    replayed = robotMessages(dict(parameters, replayFilename=filename), 30)
+    assert len(replayed) == len(recorded) == 20
+    for a, b in zip(recorded, replayed):
+        assert a[0] == b[0]
+        assert np.float32(a[1]) == b[1]
+        assert a[3:] == b[3:]
+        if a[0] == 'update': assert a[2] == b[2]
+
+# Replay a recording, returns the prediction and the filter data of every
+# iteration
+def replay(parameters, filename, iterations, **changes):
+    session = quiet(lambda: Session.Session(dict(parameters, replayFilename=filename, iterations=iterations,
+                                                 initialWeightThres=0.8, **changes), 0))
+    run = []
+    try:
+        quiet(session.start)
+        while not session.done():
+            quiet(session.step)
+            run.append((session.prediction, session.parms['pfObject'].data))
+    finally:
+        session.close()
+    return run
+
+# Replaying a recording runs the filter the same way every time
+def test_replay_is_deterministic(parameters, tmp_path):
+    filename = str(tmp_path / "run.rep")
+    random.seed(1)
+    robotMessages(dict(parameters, robotX=250, robotY=200, robotH=0.0, recordFilename=filename), 15)
+    runs = [replay(parameters, filename, 15, numberOfParticles=100) for i in range(2)]
+    assert runs[0] == runs[1]
+    assert len(runs[0]) == 15
+    assert any(radius > 0 for (x, y, radius), data in runs[0])
+
+# redistributeTries only limits the placement with headingSource 'search',
+# a magnetometer run places the particles as before
+def test_redistribute_tries_magnetometer(parameters, tmp_path):
+    filename = str(tmp_path / "run.rep")
+    random.seed(0)
+    robotMessages(dict(parameters, robotX=250, robotY=200, robotH=0.0, recordFilename=filename), 40)
+    runs = [replay(parameters, filename, 40, numberOfParticles=200, redistributeTries=tries)
+            for tries in (parameters['redistributeTries'], 1)]
+    assert runs[0] == runs[1]
@@ -0,0 +1,61 @@
+# Experiments in robot localization using particle filters (algorithm and simulator)
+# Copyright (C) <2021>  Eric Gregori
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import math
+import socket
+import numpy as np
+import RobotServer as rs
+from conftest import quiet
+
+def test_frame_codec():
+    lidar = np.arange(36) * 7 % 50
+    frame = rs.encodeFrame(rs.MSG_UPDATE, 1.25, 21.5, lidar, (120.0, 80.0))
+    assert len(frame) == rs.frameSize(36)
+    header = rs.FRAME_HEADER.unpack_from(frame)
+    assert header == (rs.MSG_UPDATE, 0, 36, 1.25, 21.5, 120.0, 80.0)
+    assert np.array_equal(np.frombuffer(frame, '<u2', offset=rs.FRAME_HEADER.size), lidar)
+    (tx, ty) = rs.FRAME_HEADER.unpack_from(rs.encodeFrame(rs.MSG_INIT, 0.0, 0.0, lidar))[5:]
+    assert math.isnan(tx) and math.isnan(ty)
+
+def freePort():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+# A robot connects and sends a frame. stop() closes the connection and the
+# listening socket, so the port can be used again.
+def test_server_start_stop(parameters):
+    parameters = dict(parameters, serverIP='127.0.0.1', serverPort=freePort(), serverTimeout=5.0)
+    lidar = np.arange(parameters['lidarSamples']) % 50
+    for run in range(2):
+        server = rs.RobotServer(parameters)
+        assert quiet(lambda: server.start(parameters)) == 0
+        robot = socket.create_connection((parameters['serverIP'], parameters['serverPort']))
+        try:
+            robot.sendall(rs.encodeFrame(rs.MSG_INIT, 0.75, 0.0, lidar))
+            assert server.getDataFromRobot(parameters, []) == 'init'
+            assert np.float32(parameters['robotHeading']) == np.float32(0.75)
+            assert np.array_equal(parameters['robotLidarData'], lidar)
+        finally:
+            server.stop()
+            assert server.loop is None
+            assert robot.recv(1) == b''
+            robot.close()
+
+def test_stop_without_server(parameters):
+    server = quiet(lambda: rs.RobotServer(parameters))
+    server.stop()
+    assert server.loop is None
@@ -0,0 +1,75 @@
+# Experiments in robot localization using particle filters (algorithm and simulator)
+# Copyright (C) <2021>  Eric Gregori
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import statistics
+import pytest
+import Arena
+from conftest import quiet, defaultParameters, track
+
+@pytest.fixture(scope='module')
+def likelihood_arena(cache_directory):
+    return quiet(lambda: Arena.Arena(dict(defaultParameters(cache_directory), sensorModel='likelihood')))
+
+# The filter converges and follows the simulated robot, median error in
+# pixels over the second half of the run
+@pytest.mark.parametrize('weight_model', ['correlation', 'gaussian'])
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_tracks_the_robot(parameters, weight_model, seed):
+    parameters['weightModel'] = weight_model
+    errors = track(parameters, 60, seed=seed)
+    assert len(errors) > 20
+    assert statistics.median(errors[len(errors)//2:]) < 20
+
+# The likelihood field model converges too, the beams that did not hit a
+# wall rule out the poses that would see one
+@pytest.mark.parametrize('seed', range(7))
+def test_tracks_the_robot_likelihood(parameters, likelihood_arena, seed):
+    parameters.update(sensorModel='likelihood', arena=likelihood_arena)
+    errors = track(parameters, 60, seed=seed)
+    assert len(errors) > 20
+    assert statistics.median(errors[len(errors)//2:]) < 20
+
+# Without a magnetometer the headings come from the scans, the heading is
+# a beam wide so the error is larger
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_tracks_the_robot_heading_search(parameters, seed):
+    parameters['headingSource'] = 'search'
+    errors = track(parameters, 60, seed=seed)
+    assert len(errors) > 20
+    assert statistics.median(errors[len(errors)//2:]) < 30
+
+# Scan matching must not make the tracking worse
+@pytest.mark.parametrize('seed', [0, 1, 2, 3])
+def test_tracks_the_robot_scan_matching(parameters, seed):
+    parameters['scanMatching'] = True
+    errors = track(parameters, 60, seed=seed)
+    assert len(errors) > 20
+    assert statistics.median(errors[len(errors)//2:]) < 20
+
+# With lowvariance resampling the scan match draws part of the particles
+# around the matched pose, the particles end up closer to the robot
+def test_scan_matching_tightens_lowvariance(parameters):
+    parameters['resampleMode'] = 'lowvariance'
+    spread = []
+    for scan_matching in (False, True):
+        medians = []
+        for seed in range(4):
+            spreads = []
+            errors = track(dict(parameters, scanMatching=scan_matching), 60, seed=seed, spreads=spreads)
+            assert statistics.median(errors[len(errors)//2:]) < 20
+            medians.append(statistics.median(spreads[len(spreads)//2:]))
+        spread.append(statistics.mean(medians))
+    assert spread[1] < 0.8 * spread[0]
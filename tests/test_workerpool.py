@@ -0,0 +1,91 @@
+# Experiments in robot localization using particle filters (algorithm and simulator)
+# Copyright (C) <2021>  Eric Gregori
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import numpy as np
+import pytest
+import LidarBotModel as model
+import WorkerPool
+import Instrumentation
+from conftest import quiet
+
+# A robot update and particles at the first valid regions
+@pytest.fixture
+def update(parameters, arena):
+    regions = np.asarray(arena.valid_regions).reshape(-1, 2)
+    x, y = regions[len(regions) // 2]
+    parameters['robotHeading']      = 0.5
+    parameters['robotDistance']     = 10
+    parameters['robotLidarData']    = [0] * parameters['lidarSamples']
+    parameters['robotValidLidar']   = arena.readLidar(x, y, parameters['robotLidarData'],
+                                                    heading=parameters['robotHeading'])
+    parameters['workerShardSize']   = 64
+    particles = model.ParticleSet(parameters, rng=np.random.default_rng(0))
+    particles.add(regions[:300,0], regions[:300,1], weigh=False)
+    return parameters, particles
+
+def shardMove(parameters, particles, seed, update, shard):
+    task = ('move', seed, update, shard, {k: parameters[k] for k in WorkerPool.UPDATE_PARAMETERS},
+            True, particles.x, particles.y, particles.heading, particles.weight)
+    return WorkerPool.runShard(task)
+
+# A shard's noise only depends on the pool seed, the update and the shard
+def test_shard_rng(parameters, arena, update):
+    parameters, particles = update
+    description = arena.share()
+    recorder = Instrumentation.recorder
+    try:
+        static = {k: parameters[k] for k in WorkerPool.STATIC_PARAMETERS}
+        WorkerPool.initWorker(description, static)
+        first = shardMove(parameters, particles, 11, 1, 0)
+        again = shardMove(parameters, particles, 11, 1, 0)
+        assert all(np.array_equal(a, b) for a, b in zip(first[:6], again[:6]))
+        for other in ((11, 1, 1), (11, 2, 0), (12, 1, 0)):
+            assert not np.array_equal(first[0], shardMove(parameters, particles, *other)[0])
+    finally:
+        Instrumentation.recorder = recorder
+        arena.unshare()
+
+# The result does not depend on the number of workers
+def test_pool_is_deterministic(update):
+    parameters, particles = update
+    moved = []
+    for workers in (1, 2):
+        copy = model.ParticleSet(parameters, rng=np.random.default_rng(0))
+        copy.extend(particles)
+        pool = quiet(lambda: WorkerPool.WorkerPool(dict(parameters, workers=workers), np.random.default_rng(7)))
+        try:
+            pool.move(copy, parameters)
+        finally:
+            pool.close()
+        moved.append(copy)
+    for name in ('x', 'y', 'heading', 'weight', 'samples', 'valid'):
+        assert np.array_equal(getattr(moved[0], name), getattr(moved[1], name))
+    assert not np.array_equal(moved[0].x, particles.x)
+
+# The counts of the workers are added to the parent's
+def test_pool_counts(update):
+    parameters, particles = update
+    Instrumentation.recorder = Instrumentation.Counter()
+    try:
+        pool = quiet(lambda: WorkerPool.WorkerPool(dict(parameters, workers=2), np.random.default_rng(7)))
+        try:
+            pool.move(particles, parameters)
+        finally:
+            pool.close()
+        counts = Instrumentation.recorder.take()
+    finally:
+        Instrumentation.recorder = None
+    assert counts.get('motionProbes', 0) > 0